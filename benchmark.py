@@ -0,0 +1,185 @@
+"""Mr.Vector ベンチマーク
+
+使い方:
+    python benchmark.py                 # 全項目（合成データ）
+    python benchmark.py startup         # 起動（import→ready）時間のみ
+    python benchmark.py startup --live  # 実際のSupabaseからインデックスを構築して計測
+    python benchmark.py search          # 1件ずつの検索とsearch_manyの比較
+    python benchmark.py workers         # 共有インデックスを使うワーカー数ごとのスループット
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+import numpy as np
+
+
+# 合成コーパス（API不要で再現可能）
+def synthetic_corpus(rows, dim, seed=0):
+    rng = np.random.default_rng(seed)
+    embeddings = rng.standard_normal((rows, dim), dtype=np.float32)
+    records = [
+        {"id": i, "message_text": f"synthetic message {i}", "user_id": "U0", "timestamp": None}
+        for i in range(rows)
+    ]
+    return embeddings, records
+
+
+# 子プロセス側: import開始からreadyまでを計測してJSONで出力
+def _startup_child(rows, dim, live):
+    started = time.perf_counter()
+    import slack_vector_bot as bot
+    imported = time.perf_counter()
+
+    loader = None
+    if not live:
+        from vector_index import EmbeddingIndex
+
+        def loader(progress):
+            embeddings, records = synthetic_corpus(rows, dim)
+            progress(len(records))
+            return EmbeddingIndex(embeddings, records)
+
+    bot.start_background_warmup(loader=loader, refresh_seconds=0)
+    while not bot.is_ready():
+        if bot.warmup_status["state"] == "failed":
+            raise SystemExit(f"warm-up failed: {bot.warmup_status['error']}")
+        time.sleep(0.005)
+    ready = time.perf_counter()
+    print(json.dumps({
+        "import_s": round(imported - started, 3),
+        "import_to_ready_s": round(ready - started, 3),
+        "rows": len(bot.search_index),
+    }))
+
+
+def bench_startup(args):
+    env = dict(os.environ)
+    if not args.live:
+        # クライアントは遅延生成のため、ダミー値でもimport/readyは計測できる
+        for key in ("SUPABASE_URL", "SUPABASE_KEY", "OPENAI_API_KEY", "SLACK_BOT_TOKEN", "SLACK_SIGNING_SECRET"):
+            env.setdefault(key, "https://example.invalid" if key == "SUPABASE_URL" else "dummy")
+    cmd = [sys.executable, os.path.abspath(__file__), "--startup-child",
+           "--rows", str(args.rows), "--dim", str(args.dim)]
+    if args.live:
+        cmd.append("--live")
+    results = []
+    for _ in range(args.repeat):
+        out = subprocess.run(cmd, env=env, capture_output=True, text=True, check=True)
+        results.append(json.loads(out.stdout.strip().splitlines()[-1]))
+    imports = [r["import_s"] for r in results]
+    readies = [r["import_to_ready_s"] for r in results]
+    print(f"[startup] rows={results[0]['rows']} "
+          f"import={np.median(imports):.3f}s import_to_ready={np.median(readies):.3f}s "
+          f"(median of {args.repeat})")
+
+
+# 1クエリずつの検索と search_many（行列積1回）の比較
+def bench_search(args):
+    from vector_index import EmbeddingIndex
+
+    embeddings, records = synthetic_corpus(args.rows, args.dim)
+    index = EmbeddingIndex(embeddings, records)
+    queries = np.random.default_rng(1).standard_normal((args.queries, args.dim), dtype=np.float32)
+
+    started = time.perf_counter()
+    for query in queries:
+        index.search(query, top_k=5)
+    single = time.perf_counter() - started
+
+    started = time.perf_counter()
+    index.search_many(queries, top_k=5)
+    batched = time.perf_counter() - started
+
+    print(f"[search] rows={args.rows} dim={args.dim} queries={args.queries} "
+          f"single={single:.3f}s ({args.queries / single:.0f} qps) "
+          f"search_many={batched:.3f}s ({args.queries / batched:.0f} qps) x{single / batched:.1f}")
+
+
+# 共有インデックスにアタッチしたワーカープロセスでの検索（1クエリずつ）
+def _search_worker(directory, queries, barrier, results):
+    from shared_index import SharedIndexReader
+
+    index = SharedIndexReader(directory, wait_seconds=10).load()
+    barrier.wait()
+    started = time.perf_counter()
+    for query in queries:
+        index.search(query, top_k=5)
+    results.put(time.perf_counter() - started)
+
+
+# ワーカー数を増やしたときの検索スループット（共有メモリ上の1つの行列を全ワーカーで参照）
+def bench_workers(args):
+    import shutil
+    import tempfile
+    import multiprocessing
+    from shared_index import publish_index
+    from vector_index import EmbeddingIndex
+
+    embeddings, records = synthetic_corpus(args.rows, args.dim)
+    directory = tempfile.mkdtemp(prefix="mrvector-bench-", dir="/dev/shm" if os.path.isdir("/dev/shm") else None)
+    publish_index(EmbeddingIndex(embeddings, records), directory)
+    queries = np.random.default_rng(1).standard_normal((args.queries, args.dim), dtype=np.float32)
+
+    # BLASスレッドは1に固定し、ワーカー数によるスケーリングだけを測る
+    for key in ("OPENBLAS_NUM_THREADS", "OMP_NUM_THREADS", "MKL_NUM_THREADS"):
+        os.environ[key] = "1"
+    ctx = multiprocessing.get_context("spawn")
+    counts = sorted({1, 2, os.cpu_count() or 1} if not args.workers else set(args.workers))
+    try:
+        _run_workers(directory, queries, counts, ctx, embeddings.nbytes, args)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def _run_workers(directory, queries, counts, ctx, matrix_bytes, args):
+    baseline = None
+    for count in counts:
+        barrier = ctx.Barrier(count)
+        results = ctx.Queue()
+        procs = [ctx.Process(target=_search_worker, args=(directory, queries, barrier, results)) for _ in range(count)]
+        for p in procs:
+            p.start()
+        elapsed = [results.get() for _ in procs]
+        for p in procs:
+            p.join()
+        qps = count * len(queries) / max(elapsed)
+        baseline = baseline or qps
+        print(f"[workers] workers={count} rows={args.rows} dim={args.dim} "
+              f"matrix={matrix_bytes / 2**20:.0f}MiB(shared) {qps:.0f} qps (x{qps / baseline:.2f})")
+
+
+SECTIONS = {
+    "startup": bench_startup,
+    "search": bench_search,
+    "workers": bench_workers,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mr.Vector ベンチマーク")
+    parser.add_argument("sections", nargs="*", help=f"計測項目 ({', '.join(SECTIONS)})")
+    parser.add_argument("--rows", type=int, default=20000)
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--queries", type=int, default=1000)
+    parser.add_argument("--workers", type=int, nargs="*", help="workers計測時のワーカー数（既定: 1, 2, CPU数）")
+    parser.add_argument("--live", action="store_true", help="実際のSupabase/OpenAIを使用する")
+    parser.add_argument("--startup-child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.startup_child:
+        _startup_child(args.rows, args.dim, args.live)
+        return
+
+    unknown = [name for name in args.sections if name not in SECTIONS]
+    if unknown:
+        parser.error(f"不明な計測項目: {', '.join(unknown)}")
+    for name in args.sections or list(SECTIONS):
+        SECTIONS[name](args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+import os
+import logging
+import threading
+from vector_index import normalize_rows, parse_embedding
+
+try:
+    import tiktoken
+except ImportError:  # tiktoken未導入時は文字数で概算する
+    tiktoken = None
+
+logger = logging.getLogger(__name__)
+
+# プロンプト予算（トークン数）
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "1500"))  # 参考メッセージ全体
+MESSAGE_TOKEN_LIMIT = int(os.getenv("MESSAGE_TOKEN_LIMIT", "300"))  # 参考メッセージ1件あたり
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "800"))  # 会話履歴全体
+HISTORY_TURN_TOKEN_LIMIT = int(os.getenv("HISTORY_TURN_TOKEN_LIMIT", "300"))  # 会話履歴1件あたり
+# MMR: 1.0に近いほど関連度重視、0に近いほど多様性重視
+MMR_LAMBDA = float(os.getenv("MMR_LAMBDA", "0.7"))
+# 選択済みメッセージとの類似度がこれ以上なら重複とみなして除外
+DUPLICATE_SIMILARITY = float(os.getenv("DUPLICATE_SIMILARITY", "0.95"))
+
+# チャット形式の1メッセージあたりのオーバーヘッド（role等）
+_MESSAGE_OVERHEAD_TOKENS = 4
+
+_encoder = None
+_encoder_lock = threading.Lock()
+
+
+# ローカルトークナイザーを取得（初回のみ読み込み。失敗時はNone）
+def get_encoder(model="gpt-3.5-turbo"):
+    global _encoder
+    if tiktoken is None:
+        return None
+    if _encoder is None:
+        with _encoder_lock:
+            if _encoder is None:
+                try:
+                    _encoder = tiktoken.encoding_for_model(model)
+                except Exception as e:
+                    logger.warning(f"トークナイザー読み込み失敗（文字数で概算します）: {e}")
+                    _encoder = False
+    return _encoder or None
+
+
+def count_tokens(text):
+    encoder = get_encoder()
+    if encoder is None:
+        return len(text)
+    return len(encoder.encode(text))
+
+
+# チャットメッセージ列のトークン数
+def count_message_tokens(messages):
+    return sum(count_tokens(m["content"]) + _MESSAGE_OVERHEAD_TOKENS for m in messages)
+
+
+# max_tokens以内に切り詰める（省略記号の分も含めて予算内に収める）
+def truncate_to_tokens(text, max_tokens):
+    if max_tokens <= 1:
+        return ""
+    encoder = get_encoder()
+    if encoder is None:
+        return text if len(text) <= max_tokens else text[:max_tokens - 1] + "…"
+    tokens = encoder.encode(text)
+    if len(tokens) <= max_tokens:
+        return text
+    ellipsis = len(encoder.encode("…"))
+    return encoder.decode(tokens[:max(0, max_tokens - ellipsis)]) + "…"
+
+
+def _candidate_vector(msg):
+    vector = msg.get("vector")
+    if vector is None and msg.get("embedding") is not None:
+        try:
+            vector = parse_embedding(msg["embedding"])
+        except Exception:
+            vector = None
+    return None if vector is None else normalize_rows(vector)
+
+
+# 最大限界関連性(MMR)で上位k件を選び、ほぼ同一の投稿を除外する
+def mmr_select(candidates, top_k, lambda_=MMR_LAMBDA, duplicate_similarity=DUPLICATE_SIMILARITY):
+    vectors = [_candidate_vector(msg) for msg in candidates]
+    remaining = list(range(len(candidates)))
+    selected = []
+    while remaining and len(selected) < top_k:
+        best, best_score = None, None
+        for i in list(remaining):
+            redundancy = 0.0
+            if vectors[i] is not None:
+                sims = [float(vectors[i] @ vectors[j]) for j in selected if vectors[j] is not None]
+                redundancy = max(sims, default=0.0)
+            if redundancy >= duplicate_similarity:
+                remaining.remove(i)
+                continue
+            score = lambda_ * candidates[i].get("similarity", 0.0) - (1 - lambda_) * redundancy
+            if best_score is None or score > best_score:
+                best, best_score = i, score
+        if best is None:
+            break
+        selected.append(best)
+        remaining.remove(best)
+    return [candidates[i] for i in selected]
+
+
+# 参考メッセージ部分を予算内で組み立てる
+def build_context(candidates, top_k=5, budget=CONTEXT_TOKEN_BUDGET, per_message=MESSAGE_TOKEN_LIMIT):
+    selected = mmr_select(candidates, top_k)
+    lines = []
+    used = 0
+    for msg in selected:
+        text = truncate_to_tokens(msg.get("message_text") or "", per_message)
+        line = f"{len(lines) + 1}. 類似度: {msg.get('similarity', 0):.3f} - {text}"
+        tokens = count_tokens(line)
+        if used + tokens > budget:
+            line = truncate_to_tokens(line, budget - used)
+            tokens = count_tokens(line)
+            if tokens <= 0 or used + tokens > budget:
+                break
+        lines.append(line)
+        used += tokens
+    return selected[:len(lines)], "\n".join(lines), used
+
+
+# 会話履歴を新しい順に予算内で詰め、時系列順で返す
+# 長い回答1件で履歴全体が押し出されないよう、1件ずつper_turn以内に切り詰めてから詰める
+def budget_history(history, budget=HISTORY_TOKEN_BUDGET, max_turns=5, per_turn=HISTORY_TURN_TOKEN_LIMIT):
+    picked = []
+    used = 0
+    for hist in reversed(history[-max_turns:]):
+        if hist.get("role") not in ("user", "assistant"):
+            continue
+        content = truncate_to_tokens(hist["content"], per_turn)
+        tokens = count_tokens(content) + _MESSAGE_OVERHEAD_TOKENS
+        if used + tokens > budget:
+            # 残りの予算に収まるところまで切り詰め、それより古い履歴は入れない
+            content = truncate_to_tokens(content, budget - used - _MESSAGE_OVERHEAD_TOKENS)
+            tokens = count_tokens(content) + _MESSAGE_OVERHEAD_TOKENS
+            if not content or used + tokens > budget:
+                break
+            picked.append({"role": hist["role"], "content": content})
+            used += tokens
+            break
+        picked.append({"role": hist["role"], "content": content})
+        used += tokens
+    picked.reverse()
+    return picked, used
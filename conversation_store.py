@@ -0,0 +1,82 @@
+import time
+import sqlite3
+import threading
+
+# 1会話あたりの保持件数（MAX_ENTRIESを超えたら最新KEEP_ENTRIES件に切り詰める）
+MAX_ENTRIES = 20
+KEEP_ENTRIES = 10
+
+
+class MemoryConversationStore:
+    """プロセス内の辞書に会話履歴を保持する（単一プロセス用）"""
+
+    def __init__(self):
+        self._history = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            return list(self._history.get(key, []))
+
+    def append(self, key, entries):
+        with self._lock:
+            history = self._history.setdefault(key, [])
+            history.extend(entries)
+            if len(history) > MAX_ENTRIES:
+                self._history[key] = history[-KEEP_ENTRIES:]
+
+
+class SQLiteConversationStore:
+    """SQLiteファイルに会話履歴を保持する（同一ホストの複数ワーカーで共有）"""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute(
+                "create table if not exists conversation_history ("
+                " seq integer primary key autoincrement,"
+                " conversation_key text not null,"
+                " role text not null,"
+                " content text not null,"
+                " created_at real not null)"
+            )
+            conn.execute(
+                "create index if not exists conversation_history_key_idx"
+                " on conversation_history (conversation_key, seq)"
+            )
+
+    # スレッドごとに接続を持つ（WALで読み書きを並行させる）
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute("pragma journal_mode=wal")
+            conn.execute("pragma synchronous=normal")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key):
+        rows = self._connect().execute(
+            "select role, content, created_at from conversation_history"
+            " where conversation_key = ? order by seq",
+            (key,),
+        ).fetchall()
+        return [{"role": role, "content": content, "timestamp": created_at} for role, content, created_at in rows]
+
+    def append(self, key, entries):
+        with self._connect() as conn:
+            conn.executemany(
+                "insert into conversation_history (conversation_key, role, content, created_at) values (?, ?, ?, ?)",
+                [(key, e["role"], e["content"], time.time()) for e in entries],
+            )
+            (count,) = conn.execute(
+                "select count(*) from conversation_history where conversation_key = ?", (key,)
+            ).fetchone()
+            if count > MAX_ENTRIES:
+                conn.execute(
+                    "delete from conversation_history where conversation_key = ? and seq not in ("
+                    " select seq from conversation_history where conversation_key = ?"
+                    " order by seq desc limit ?)",
+                    (key, key, KEEP_ENTRIES),
+                )
@@ -0,0 +1,30 @@
+import os
+
+# 保存ベクトルと検索クエリで同じモデル・次元を使うための共通設定
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "text-embedding-3-small")
+EMBEDDING_DIM = int(os.getenv("EMBEDDING_DIM", "1536"))  # text-embedding-3系は256/512などに縮小可能
+
+# 1件あたりの最大文字数（トークン上限超過によるAPIエラー防止）
+MAX_EMBED_CHARS = 6000
+
+# dimensionsパラメータに対応しているモデル
+_SHORTENABLE_PREFIX = "text-embedding-3"
+
+
+# 複数テキストを1回のAPI呼び出しでベクトル化（入力順で返す）
+def embed_texts(client, texts, model=EMBEDDING_MODEL, dimensions=EMBEDDING_DIM, **kwargs):
+    inputs = [(text or " ")[:MAX_EMBED_CHARS] for text in texts]
+    if dimensions and model.startswith(_SHORTENABLE_PREFIX):
+        kwargs["dimensions"] = dimensions
+    response = client.embeddings.create(input=inputs, model=model, **kwargs)
+    data = sorted(response.data, key=lambda d: d.index)
+    embeddings = [d.embedding for d in data]
+    for emb in embeddings:
+        if dimensions and len(emb) != dimensions:
+            raise ValueError(f"embedding次元数不一致: {len(emb)} (期待値 {dimensions})")
+    return embeddings
+
+
+# 行に記録するモデル情報
+def embedding_metadata(model=EMBEDDING_MODEL, dimensions=EMBEDDING_DIM):
+    return {"embedding_model": model, "embedding_dim": dimensions}
@@ -0,0 +1,274 @@
+"""検索の品質(recall@k, MRR)と速度を検索方式ごとに比較する評価ツール
+
+記録済みのクエリembeddingとコーパスのスナップショットを使うため、評価時にAPIは不要。
+いずれかの方式のrecall@kが --recall-floor を下回ると終了コード1で終了する。
+
+使い方:
+    # 1. 質問セットのembeddingとコーパスを記録（ここだけAPI/Supabaseを使用）
+    python evaluate_retrieval.py record --queries eval/queries.jsonl --corpus eval/corpus.jsonl
+    # 2. 評価
+    python evaluate_retrieval.py run --queries eval/queries.jsonl --corpus eval/corpus.jsonl --k 5
+    # 合成データでの動作確認
+    python evaluate_retrieval.py run --synthetic 20000
+
+質問セット(JSONL)の各行:
+    {"query": "撮影の予定について", "relevant": [123, 456], "filter": {"channel_id": "C0123"}, "embedding": [...]}
+    relevant を省略した場合は exact 検索の上位k件を正解とみなす。filter は filtered・sharded 方式で使う
+    （"month" は timestamp の年月）。sharded は常に同じ条件の exact 検索の上位k件と比べる。
+    channel_id で絞り込む場合は、migrations/002_channel_id_column.sql の適用後に記録したコーパスを使う。
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import numpy as np
+from vector_index import EmbeddingIndex, QuantizedIndex, IVFIndex, ShardedIndex, record_field
+from lexical_index import LexicalIndex, hybrid_search
+
+CONFIGS = ["exact", "quantized", "ann", "filtered", "hybrid", "sharded"]
+
+
+def read_jsonl(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def write_jsonl(path, rows):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        for row in rows:
+            f.write(json.dumps(row, ensure_ascii=False) + "\n")
+
+
+# コーパス(JSONL)を埋め込み行列とレコードに分割
+def load_corpus(path):
+    rows = read_jsonl(path)
+    embeddings = np.array([row.pop("embedding") for row in rows], dtype=np.float32)
+    return embeddings, rows
+
+
+# 合成データ（トピックごとのクラスタ。質問は各文書の近傍、正解はその文書）
+# クラスタ同士が重なるほど広げ、質問にも大きめのノイズを乗せてあるため、
+# nprobeの小さいANNは正解を取りこぼす（文書固有の語は質問文に含めない）
+def synthetic_dataset(rows, dim=256, queries=500, topics=200, seed=0):
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((topics, dim), dtype=np.float32)
+    topic_of = rng.integers(topics, size=rows)
+    embeddings = centers[topic_of] + 2.5 * rng.standard_normal((rows, dim), dtype=np.float32)
+    records = [
+        {"id": i, "message_text": f"topic{t} word{i % 97}", "channel_id": f"C{t % 8}",
+         "timestamp": f"2024-{i % 12 + 1:02d}-01T00:00:00"}
+        for i, t in enumerate(topic_of)
+    ]
+    dataset = []
+    for n, doc in enumerate(rng.choice(rows, size=queries, replace=False)):
+        query = {
+            "query": f"topic{topic_of[doc]} word{doc % 97}",
+            "embedding": (embeddings[doc] + 2.0 * rng.standard_normal(dim, dtype=np.float32)).tolist(),
+            "relevant": [int(doc)],
+        }
+        if n % 3 == 0:
+            query["filter"] = {"channel_id": records[doc]["channel_id"]}
+        elif n % 3 == 1:
+            query["filter"] = {"month": records[doc]["timestamp"][:7]}
+        dataset.append(query)
+    return embeddings, records, dataset
+
+
+def build_searchers(embeddings, records, args):
+    """方式名 -> (構築時間, 1クエリ検索関数, 対象クエリの条件)"""
+    searchers = {}
+
+    started = time.perf_counter()
+    exact = EmbeddingIndex(embeddings, records)
+    exact_seconds = time.perf_counter() - started
+
+    def exact_search(q, k, where=None):
+        return exact.search(q["embedding"], top_k=k, min_similarity=-1.0, where=where)
+
+    searchers["exact"] = (exact_seconds, exact_search, None)
+
+    started = time.perf_counter()
+    quantized = QuantizedIndex(embeddings, records)
+    searchers["quantized"] = (
+        time.perf_counter() - started,
+        lambda q, k: quantized.search(q["embedding"], top_k=k, min_similarity=-1.0),
+        None,
+    )
+
+    started = time.perf_counter()
+    ann = IVFIndex(embeddings, records, nlist=args.nlist, nprobe=args.nprobe)
+    searchers["ann"] = (
+        time.perf_counter() - started,
+        lambda q, k: ann.search(q["embedding"], top_k=k, min_similarity=-1.0),
+        None,
+    )
+
+    searchers["filtered"] = (
+        exact_seconds,
+        lambda q, k: exact.search(q["embedding"], top_k=k, min_similarity=-1.0, where=q["filter"]),
+        lambda q: bool(q.get("filter")),
+    )
+
+    started = time.perf_counter()
+    lexical = LexicalIndex(records)
+    searchers["hybrid"] = (
+        exact_seconds + time.perf_counter() - started,
+        lambda q, k: hybrid_search(exact, lexical, q["embedding"], q.get("query", ""), top_k=k),
+        None,
+    )
+
+    # 月・channel_idごとにシャード分割（filter付きクエリは該当シャードだけを走査する）
+    started = time.perf_counter()
+    sharded = ShardedIndex.from_index(exact, ["month", "channel_id"])
+    searchers["sharded"] = (
+        exact_seconds + time.perf_counter() - started,
+        lambda q, k: sharded.search(q["embedding"], top_k=k, min_similarity=-1.0, where=q.get("filter")),
+        None,
+    )
+    return exact_search, searchers
+
+
+def reciprocal_rank(ids, relevant):
+    for rank, doc_id in enumerate(ids, 1):
+        if doc_id in relevant:
+            return 1.0 / rank
+    return 0.0
+
+
+def evaluate(searcher, queries, k, ground_truth):
+    recalls, reciprocal_ranks, latencies = [], [], []
+    for q, relevant in zip(queries, ground_truth):
+        started = time.perf_counter()
+        results = searcher(q, k)
+        latencies.append((time.perf_counter() - started) * 1000)
+        ids = [r.get("id") for r in results]
+        recalls.append(len(relevant.intersection(ids)) / len(relevant) if relevant else 1.0)
+        reciprocal_ranks.append(reciprocal_rank(ids, relevant))
+    return {
+        "queries": len(queries),
+        "recall": float(np.mean(recalls)),
+        "mrr": float(np.mean(reciprocal_ranks)),
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p95_ms": float(np.percentile(latencies, 95)),
+    }
+
+
+def run(args):
+    if args.synthetic:
+        embeddings, records, queries = synthetic_dataset(args.synthetic, dim=args.dim)
+    else:
+        if not args.queries or not args.corpus:
+            raise SystemExit("--queries と --corpus（または --synthetic）を指定してください")
+        embeddings, records = load_corpus(args.corpus)
+        queries = read_jsonl(args.queries)
+    missing = [q.get("query") for q in queries if not q.get("embedding")]
+    if missing:
+        raise SystemExit(f"embedding未記録のクエリがあります（recordを先に実行）: {missing[:3]}")
+
+    # コーパスに無い項目での絞り込みは検索品質と関係なく0件になるため、評価前に止める
+    fields = {field for q in queries for field in (q.get("filter") or {})}
+    absent = sorted(f for f in fields if all(record_field(r, f) is None for r in records))
+    if absent:
+        raise SystemExit(f"コーパスに絞り込み項目がありません: {', '.join(absent)}（channel_idはmigrations/002適用後にrecordし直す）")
+
+    configs = args.configs.split(",") if args.configs else CONFIGS
+    unknown = [c for c in configs if c not in CONFIGS]
+    if unknown:
+        raise SystemExit(f"不明な方式: {', '.join(unknown)}")
+
+    exact_search, searchers = build_searchers(embeddings, records, args)
+    print(f"コーパス {len(records)}件 (dim={embeddings.shape[1]}), クエリ {len(queries)}件, k={args.k}")
+    print(f"{'config':<10} {'queries':>7} {'recall@k':>9} {'MRR':>6} {'p50 ms':>8} {'p95 ms':>8} {'build s':>8}")
+
+    failures = []
+    for name in configs:
+        build_seconds, searcher, applies = searchers[name]
+        targets = [q for q in queries if applies is None or applies(q)]
+        if not targets:
+            print(f"{name:<10} {'-':>7}  (対象クエリなし)")
+            continue
+        # 正解: ラベルがあればそれ、なければ同条件のexact検索上位k件
+        ground_truth = []
+        for q in targets:
+            if name == "sharded":
+                # シャード分割しても結果が変わらないことを確認するため、同条件のexact検索と比べる
+                ground_truth.append({r.get("id") for r in exact_search(q, args.k, q.get("filter"))})
+            elif q.get("relevant") is not None:
+                ground_truth.append(set(q["relevant"]))
+            elif name == "filtered":
+                ground_truth.append({r.get("id") for r in searchers["filtered"][1](q, args.k)})
+            else:
+                ground_truth.append({r.get("id") for r in exact_search(q, args.k)})
+        metrics = evaluate(searcher, targets, args.k, ground_truth)
+        status = ""
+        if metrics["recall"] < args.recall_floor:
+            failures.append(name)
+            status = f"  FAIL (< {args.recall_floor})"
+        print(f"{name:<10} {metrics['queries']:>7} {metrics['recall']:>9.3f} {metrics['mrr']:>6.3f} "
+              f"{metrics['p50_ms']:>8.2f} {metrics['p95_ms']:>8.2f} {build_seconds:>8.2f}{status}")
+
+    if failures:
+        print(f"recall下限を下回った方式: {', '.join(failures)}")
+        sys.exit(1)
+
+
+# 質問セットのembeddingとSupabaseのコーパスを記録する（APIを使うのはここだけ）
+def record(args):
+    from dotenv import load_dotenv
+    from openai import OpenAI
+    from supabase import create_client
+    import embeddings
+    from vector_index import load_index_from_supabase
+
+    load_dotenv()
+    queries = read_jsonl(args.queries)
+    pending = [q for q in queries if not q.get("embedding")]
+    if pending:
+        client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+        for start in range(0, len(pending), 100):
+            batch = pending[start:start + 100]
+            for q, vector in zip(batch, embeddings.embed_texts(client, [q["query"] for q in batch])):
+                q["embedding"] = vector
+        write_jsonl(args.queries, queries)
+        print(f"[INFO] クエリembedding記録: {len(pending)}件 → {args.queries}")
+
+    if args.corpus:
+        supabase = create_client(os.getenv("SUPABASE_URL"), os.getenv("SUPABASE_KEY"))
+        index = load_index_from_supabase(
+            supabase, model=embeddings.EMBEDDING_MODEL, dim=embeddings.EMBEDDING_DIM
+        )
+        write_jsonl(args.corpus, (
+            {**record, "embedding": index.row_vector(i).tolist()} for i, record in enumerate(index.records)
+        ))
+        print(f"[INFO] コーパス記録: {len(index)}件 → {args.corpus}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="検索の品質・速度評価")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = sub.add_parser("run", help="評価を実行")
+    run_parser.add_argument("--queries")
+    run_parser.add_argument("--corpus")
+    run_parser.add_argument("--synthetic", type=int, default=0, help="合成コーパスの件数（指定時はファイル不要）")
+    run_parser.add_argument("--dim", type=int, default=256, help="合成データの次元数")
+    run_parser.add_argument("--k", type=int, default=5)
+    run_parser.add_argument("--configs", help=f"カンマ区切り ({','.join(CONFIGS)})")
+    run_parser.add_argument("--recall-floor", type=float, default=0.9)
+    run_parser.add_argument("--nlist", type=int, default=None)
+    run_parser.add_argument("--nprobe", type=int, default=8)
+    run_parser.set_defaults(func=run)
+
+    record_parser = sub.add_parser("record", help="クエリembeddingとコーパスを記録")
+    record_parser.add_argument("--queries", required=True)
+    record_parser.add_argument("--corpus", help="Supabaseのコーパスを書き出すパス")
+    record_parser.set_defaults(func=record)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+# 本番用 gunicorn 設定（pre-forkワーカー + 共有メモリの検索インデックス）
+#   gunicorn -c gunicorn.conf.py slack_vector_bot:flask_app
+import os
+import sys
+import subprocess
+import multiprocessing
+
+# 各ワーカーのBLASは1スレッドに制限し、並列性はワーカー数で確保する（numpyのimport前に設定）
+os.environ.setdefault("OPENBLAS_NUM_THREADS", "1")
+os.environ.setdefault("OMP_NUM_THREADS", "1")
+os.environ.setdefault("MKL_NUM_THREADS", "1")
+
+from shared_index import default_directory
+
+# ワーカーは共有インデックスを読み取り専用で使い、会話履歴はSQLiteで共有する
+os.environ.setdefault("SHARED_INDEX_DIR", default_directory())
+os.environ.setdefault("CONVERSATION_DB", os.path.join(os.environ["SHARED_INDEX_DIR"], "conversations.sqlite3"))
+os.makedirs(os.environ["SHARED_INDEX_DIR"], exist_ok=True)
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '3000')}"
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", "4"))  # 同一ワーカー内の同時メンションはマイクロバッチにまとめる
+timeout = 60
+
+
+_loader_process = None
+
+
+# インデックスを構築・公開するローダープロセスをマスターから1つだけ起動
+def on_starting(server):
+    global _loader_process
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "index_loader.py")
+    _loader_process = subprocess.Popen([sys.executable, script])
+    server.log.info(f"インデックスローダー起動: pid={_loader_process.pid} dir={os.environ['SHARED_INDEX_DIR']}")
+
+
+def on_exit(server):
+    if _loader_process is not None and _loader_process.poll() is None:
+        _loader_process.terminate()
+
+
+# 各ワーカーで共有インデックスの読み込みとクライアント生成を開始
+def post_fork(server, worker):
+    import slack_vector_bot
+
+    slack_vector_bot.start_background_warmup()
@@ -0,0 +1,72 @@
+"""共有検索インデックスのローダー
+
+Supabaseから検索インデックスを構築して共有メモリへ公開し、
+INDEX_REFRESH_SECONDS ごとに新しいバージョンとして差し替える。
+通常は gunicorn.conf.py がマスタープロセスから起動する。
+
+使い方:
+    python index_loader.py          # 定期更新
+    python index_loader.py --once   # 1回だけ公開して終了
+"""
+import os
+import time
+import logging
+import argparse
+from dotenv import load_dotenv
+
+load_dotenv()
+
+import embeddings
+from shared_index import publish_index, default_directory
+from vector_index import load_index_from_supabase, sort_by_partition, partition_fields
+
+logger = logging.getLogger(__name__)
+
+
+# indexを省略するとSupabaseから構築する（message_archive.py import はアーカイブから構築したものを渡す）
+def build_and_publish(directory, index=None):
+    started = time.perf_counter()
+    if index is None:
+        from supabase import create_client
+
+        supabase = create_client(os.getenv("SUPABASE_URL"), os.getenv("SUPABASE_KEY"))
+        index = load_index_from_supabase(supabase, model=embeddings.EMBEDDING_MODEL, dim=embeddings.EMBEDDING_DIM)
+    # ワーカー側でパーティションごとのシャードをコピーなしのスライスで作れるよう、並べ替えて公開する
+    partition_by = partition_fields(os.getenv("INDEX_PARTITION", "month"))
+    if partition_by:
+        index = sort_by_partition(index, partition_by)
+    version = publish_index(
+        index, directory, model=embeddings.EMBEDDING_MODEL, build_seconds=round(time.perf_counter() - started, 3)
+    )
+    return version
+
+
+# 公開→待機を繰り返す（失敗しても公開済みの旧バージョンはそのまま使われる）
+def run_loader(directory=None, refresh_seconds=None):
+    logging.basicConfig(level=logging.INFO)
+    directory = directory or os.getenv("SHARED_INDEX_DIR") or default_directory()
+    if refresh_seconds is None:
+        refresh_seconds = int(os.getenv("INDEX_REFRESH_SECONDS", "3600"))
+    retry_seconds = 30
+    while True:
+        try:
+            build_and_publish(directory)
+            wait = refresh_seconds
+        except Exception as e:
+            logger.error(f"共有インデックス構築失敗: {e}")
+            wait = retry_seconds
+        if refresh_seconds <= 0:
+            return
+        time.sleep(wait)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="共有検索インデックスのローダー")
+    parser.add_argument("--directory", help="公開先ディレクトリ（既定: SHARED_INDEX_DIR または /dev/shm/mrvector）")
+    parser.add_argument("--once", action="store_true", help="1回だけ公開して終了")
+    args = parser.parse_args()
+    run_loader(args.directory, refresh_seconds=0 if args.once else None)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+import re
+import math
+import unicodedata
+from collections import Counter, defaultdict
+import numpy as np
+
+# BM25パラメータ
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# 英数字は単語単位、それ以外（日本語など）は文字bigramで分割
+_WORD = re.compile(r"[a-z0-9]+")
+_NON_ASCII_RUN = re.compile(r"[^\x00-\x7f\s]+")
+
+
+def tokenize(text):
+    text = unicodedata.normalize("NFKC", text or "").lower()
+    tokens = _WORD.findall(text)
+    for run in _NON_ASCII_RUN.findall(text):
+        if len(run) == 1:
+            tokens.append(run)
+        else:
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return tokens
+
+
+class LexicalIndex:
+    """文字bigram/単語のBM25による語彙検索（埋め込みAPIを使わない）"""
+
+    def __init__(self, records, text_field="message_text"):
+        self.records = records
+        postings = defaultdict(list)
+        lengths = np.zeros(len(records), dtype=np.float32)
+        for row, record in enumerate(records):
+            counts = Counter(tokenize(record.get(text_field)))
+            lengths[row] = sum(counts.values())
+            for token, tf in counts.items():
+                postings[token].append((row, tf))
+        avg_length = float(lengths.mean()) if len(records) else 0.0
+        self._norm = BM25_K1 * (1 - BM25_B + BM25_B * lengths / (avg_length or 1.0))
+        self.postings = {}
+        for token, entries in postings.items():
+            rows = np.fromiter((r for r, _ in entries), dtype=np.int64, count=len(entries))
+            tfs = np.fromiter((tf for _, tf in entries), dtype=np.float32, count=len(entries))
+            idf = math.log(1 + (len(records) - len(entries) + 0.5) / (len(entries) + 0.5))
+            self.postings[token] = (rows, tfs, idf)
+
+    def __len__(self):
+        return len(self.records)
+
+    # 上位k件を(行番号配列, スコア配列)で返す（mask指定時はTrueの行のみ）
+    def search_rows(self, query_text, top_k=5, mask=None):
+        scores = np.zeros(len(self.records), dtype=np.float32)
+        for token in set(tokenize(query_text)):
+            posting = self.postings.get(token)
+            if posting is None:
+                continue
+            rows, tfs, idf = posting
+            scores[rows] += idf * tfs * (BM25_K1 + 1) / (tfs + self._norm[rows])
+        if mask is not None:
+            scores[~mask] = 0.0
+        candidates = np.flatnonzero(scores)
+        if not len(candidates) or top_k <= 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        top = candidates[np.argsort(-scores[candidates])[:top_k]]
+        return top, scores[top]
+
+    def search(self, query_text, top_k=5, mask=None):
+        rows, scores = self.search_rows(query_text, top_k, mask)
+        return [{**self.records[i], "lexical_score": float(s)} for i, s in zip(rows, scores)]
+
+
+# ベクトル検索と語彙検索の結果をReciprocal Rank Fusionで統合
+# lexicalはindexと同じrecordsから構築されていること
+def hybrid_search(index, lexical, query_embedding, query_text, top_k=5, candidates=50, rrf_k=60,
+                  where=None, with_vectors=False):
+    vector_rows, vector_sims = index.search_rows_many([query_embedding], candidates, where)[0]
+    lexical_rows, _ = lexical.search_rows(query_text, candidates, index.filter_mask(where))
+    fused = defaultdict(float)
+    for ranked in (vector_rows, lexical_rows):
+        for rank, row in enumerate(ranked):
+            fused[int(row)] += 1.0 / (rrf_k + rank + 1)
+    similarity = dict(zip(vector_rows.tolist(), vector_sims.tolist()))
+    results = []
+    for row in sorted(fused, key=fused.get, reverse=True)[:top_k]:
+        result = {**index.records[row], "similarity": similarity.get(row, 0.0), "score": fused[row]}
+        if with_vectors:
+            result["vector"] = index.row_vector(row)
+        results.append(result)
+    return results
@@ -0,0 +1,370 @@
+"""Slackメッセージとembeddingのローカル列指向アーカイブ
+
+取り込み時にメッセージとembeddingを Arrow IPC ファイルとして
+    archive/channel=<チャンネルID>/month=<YYYY-MM>/part-*.arrow
+に追記しておき、SlackやOpenAIのAPIを使わずに検索インデックスの再構築や
+Supabaseへの一括バックフィルを行えるようにする。ファイルは非圧縮のIPC形式で
+書くため、読み込み時はメモリマップしてコピーなしで列にアクセスできる。
+
+使い方:
+    python message_archive.py stats
+    python message_archive.py seed                   # slack_messagesの既存行をアーカイブに取り込む（初回のみ）
+    python message_archive.py import                 # 共有検索インデックスを再構築して公開
+    python message_archive.py import --supabase      # Supabaseに無い行も一括投入
+    python message_archive.py import --no-publish --supabase --channel C0123 --month 2024-05
+
+配置:
+    アーカイブは取り込みジョブ（slack_to_supabase.py）を実行するホストの ARCHIVE_DIR に書かれる。
+    Renderでは slack-message-processor の永続ディスク (/var/data/archive) で、Webサービスとは
+    ファイルシステムを共有しない。そのため seed・import --no-publish --supabase はこのワーカーの
+    シェルで実行し、検索インデックスはWebサービス側のローダーがSupabaseから再構築する。
+    共有検索インデックスの公開（--no-publish なしの import）は、アーカイブとWebサービスの
+    SHARED_INDEX_DIR が同じホストにある構成でのみ使える。
+"""
+import os
+import json
+import time
+import logging
+import argparse
+import threading
+from collections import defaultdict
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+from vector_index import EmbeddingIndex, parse_embedding
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_FLUSH_ROWS = int(os.getenv("ARCHIVE_FLUSH_ROWS", "1000"))
+
+# 検索インデックスのレコードに載せる列（embedding以外）
+RECORD_COLUMNS = ["id", "channel_id", "ts", "message_text", "user_id", "timestamp"]
+
+
+# 呼び出し側のload_dotenv後に読むよう、import時ではなく使う時点で参照する
+def default_directory():
+    return os.getenv("ARCHIVE_DIR", "archive")
+
+
+def archive_schema(dim):
+    return pa.schema([
+        ("id", pa.int64()),
+        ("channel_id", pa.string()),
+        ("ts", pa.string()),
+        ("message_text", pa.string()),
+        ("user_id", pa.string()),
+        ("timestamp", pa.string()),
+        ("embedding", pa.list_(pa.float32(), dim)),
+        ("embedding_model", pa.string()),
+        ("embedding_dim", pa.int32()),
+        ("raw_json", pa.string()),
+    ])
+
+
+def partition_path(directory, channel_id, timestamp):
+    month = str(timestamp or "")[:7] or "unknown"
+    return os.path.join(directory, f"channel={channel_id or 'unknown'}", f"month={month}")
+
+
+class ArchiveWriter:
+    """メッセージをパーティションごとにバッファし、flush時にpartファイルとして書き出す"""
+
+    def __init__(self, directory=None, flush_rows=None):
+        self.directory = directory or default_directory()
+        self.flush_rows = flush_rows or ARCHIVE_FLUSH_ROWS
+        self._buffers = defaultdict(list)
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.flush()
+
+    # record: channel_id, ts, message_text, user_id, timestamp, embedding, embedding_model, embedding_dim, raw_json, id
+    def append(self, record):
+        with self._lock:
+            path = partition_path(self.directory, record.get("channel_id"), record.get("timestamp"))
+            self._buffers[(path, len(record["embedding"]))].append(record)
+            self._pending += 1
+            if self._pending < self.flush_rows:
+                return
+        self.flush()
+
+    def flush(self):
+        with self._lock:
+            buffers, self._buffers, self._pending = self._buffers, defaultdict(list), 0
+        for (path, dim), records in buffers.items():
+            self._write_part(path, dim, records)
+
+    def _write_part(self, path, dim, records):
+        os.makedirs(path, exist_ok=True)
+        columns = {name: [r.get(name) for r in records] for name in RECORD_COLUMNS}
+        columns["embedding"] = pa.FixedSizeListArray.from_arrays(
+            pa.array(np.asarray([r["embedding"] for r in records], dtype=np.float32).ravel()), dim
+        )
+        columns["embedding_model"] = [r.get("embedding_model") for r in records]
+        columns["embedding_dim"] = [r.get("embedding_dim") or dim for r in records]
+        columns["raw_json"] = [
+            r["raw_json"] if isinstance(r.get("raw_json"), str) or r.get("raw_json") is None
+            else json.dumps(r["raw_json"], ensure_ascii=False)
+            for r in records
+        ]
+        table = pa.table(columns, schema=archive_schema(dim))
+        # 書き終えたファイルだけが part-*.arrow として見えるよう一時名から置き換える
+        name = f"part-{time.time_ns()}-{os.getpid()}.arrow"
+        tmp = os.path.join(path, f".{name}.tmp")
+        with pa.OSFile(tmp, "wb") as sink, pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+        os.replace(tmp, os.path.join(path, name))
+        logger.info(f"アーカイブ書き込み: {os.path.join(path, name)} ({len(records)}件)")
+
+
+def _partition_value(name, prefix):
+    return name[len(prefix):] if name.startswith(prefix) else None
+
+
+# 条件に合うpartファイルのパスを(チャンネル, 月, パス)で列挙（ディレクトリ名で絞り込む）
+def list_parts(directory=None, channels=None, months=None):
+    directory = directory or default_directory()
+    if not os.path.isdir(directory):
+        return []
+    parts = []
+    for channel_dir in sorted(os.listdir(directory)):
+        channel = _partition_value(channel_dir, "channel=")
+        if channel is None or (channels and channel not in channels):
+            continue
+        for month_dir in sorted(os.listdir(os.path.join(directory, channel_dir))):
+            month = _partition_value(month_dir, "month=")
+            if month is None or (months and month not in months):
+                continue
+            path = os.path.join(directory, channel_dir, month_dir)
+            parts.extend(
+                (channel, month, os.path.join(path, name))
+                for name in sorted(os.listdir(path)) if name.endswith(".arrow")
+            )
+    return parts
+
+
+# partファイルをメモリマップしてTableを順に返す（列のバッファはマップ上を直接参照する）
+def scan(directory=None, channels=None, months=None, columns=None):
+    for _, _, path in list_parts(directory, channels, months):
+        with pa.memory_map(path, "r") as source:
+            table = pa.ipc.open_file(source).read_all()
+        yield table.select(columns) if columns else table
+
+
+# embedding列をコピーなしで (行数, 次元) のfloat32配列として取り出す
+def embedding_matrix(table):
+    column = table.column("embedding").combine_chunks()
+    dim = column.type.list_size
+    values = column.values.to_numpy(zero_copy_only=True)
+    return values[column.offset * dim:(column.offset + len(column)) * dim].reshape(len(column), dim)
+
+
+# アーカイブから検索インデックスを構築（同じメッセージは最後に書かれた行を採用）
+def load_index(directory=None, model=None, dim=None, channels=None, months=None):
+    blocks = []
+    latest = {}
+    for table in scan(directory, channels, months, RECORD_COLUMNS + ["embedding", "embedding_model", "embedding_dim"]):
+        # 全行が条件を満たすpartはfilterせず、マップ上の列をそのまま使う
+        conditions = [pc.equal(table.column(name), value)
+                      for name, value in (("embedding_model", model), ("embedding_dim", dim)) if value]
+        if conditions:
+            mask = conditions[0] if len(conditions) == 1 else pc.and_(*conditions)
+            if not pc.all(mask).as_py():
+                table = table.filter(mask)
+        if not table.num_rows:
+            continue
+        matrix = embedding_matrix(table)
+        if blocks and matrix.shape[1] != blocks[0][0].shape[1]:
+            logger.warning(f"次元数の異なるアーカイブ行をスキップ: dim={matrix.shape[1]} ({table.num_rows}件)")
+            continue
+        rows = table.select(RECORD_COLUMNS).to_pylist()
+        for i, row in enumerate(rows):
+            latest[(row["channel_id"], row["ts"])] = (len(blocks), i)
+        blocks.append((matrix, rows))
+    if not latest:
+        return EmbeddingIndex([], [])
+    keep = defaultdict(list)
+    for block, i in sorted(latest.values()):
+        keep[block].append(i)
+    embeddings = np.concatenate([blocks[block][0][rows] for block, rows in keep.items()])
+    records = [blocks[block][1][i] for block, rows in keep.items() for i in rows]
+    return EmbeddingIndex(embeddings, records)
+
+
+# Supabaseに無いメッセージをまとめて投入する
+# 既存判定は秒単位のtimestampではなく、アーカイブ時のid、またはraw_jsonに残るSlackのtsで行う
+# （channel_id列の追加前に取り込んだ行はchannel_idが空のことがあるため、Supabase側とはtsで突き合わせる）
+def backfill_supabase(client, directory=None, table_name="slack_messages", batch_size=500, channels=None, months=None):
+    existing_ids, existing_ts = set(), set()
+    start = 0
+    while True:
+        rows = (
+            client.table(table_name).select("id, ts:raw_json->>ts")
+            .order("id").range(start, start + 999).execute().data or []
+        )
+        existing_ids.update(row["id"] for row in rows)
+        existing_ts.update(row["ts"] for row in rows if row.get("ts"))
+        start += len(rows)
+        if len(rows) < 1000:
+            break
+    seen = set()
+
+    inserted = 0
+    batch = []
+
+    def insert(batch):
+        client.table(table_name).insert(batch).execute()
+        return len(batch)
+
+    for table in scan(directory, channels, months):
+        matrix = embedding_matrix(table)
+        for i, row in enumerate(table.drop_columns(["embedding"]).to_pylist()):
+            key = (row["channel_id"], row["ts"])
+            if row["id"] in existing_ids or row["ts"] in existing_ts or key in seen:
+                continue
+            seen.add(key)
+            batch.append({
+                "channel_id": row["channel_id"],
+                "message_text": row["message_text"],
+                "user_id": row["user_id"],
+                "timestamp": row["timestamp"],
+                "embedding": matrix[i].tolist(),
+                "embedding_model": row["embedding_model"],
+                "embedding_dim": row["embedding_dim"],
+                "raw_json": json.loads(row["raw_json"]) if row["raw_json"] else None,
+            })
+            if len(batch) >= batch_size:
+                inserted += insert(batch)
+                batch = []
+    if batch:
+        inserted += insert(batch)
+    return inserted
+
+
+# slack_messagesの既存行をアーカイブに書き出す（アーカイブ済みのidはスキップ）
+# ingesterは新規に取り込んだ行しかアーカイブしないため、それ以前の行はこれで補う
+def seed_from_supabase(client, directory=None, table_name="slack_messages", page_size=1000):
+    archived = set()
+    for table in scan(directory, columns=["id"]):
+        archived.update(table.column("id").to_pylist())
+    written = 0
+    start = 0
+    with ArchiveWriter(directory) as writer:
+        while True:
+            rows = (
+                client.table(table_name)
+                .select("id, channel_id, message_text, user_id, timestamp, embedding, embedding_model, embedding_dim, raw_json")
+                .order("id").range(start, start + page_size - 1).execute().data or []
+            )
+            for row in rows:
+                if row["id"] in archived:
+                    continue
+                try:
+                    embedding = parse_embedding(row.get("embedding"))
+                except Exception as e:
+                    logger.error(f"embedding処理エラー: id={row.get('id')} {e}")
+                    continue
+                if not embedding:
+                    continue
+                raw = row.get("raw_json")
+                if isinstance(raw, str):
+                    raw = json.loads(raw)
+                writer.append({**row, "embedding": embedding, "ts": (raw or {}).get("ts"), "raw_json": raw})
+                written += 1
+            start += len(rows)
+            if len(rows) < page_size:
+                break
+    return written
+
+
+def stats(args):
+    totals = defaultdict(int)
+    for channel, month, path in list_parts(args.directory, args.channel, args.month):
+        with pa.memory_map(path, "r") as source:
+            totals[(channel, month)] += pa.ipc.open_file(source).read_all().num_rows
+    for (channel, month), rows in sorted(totals.items()):
+        print(f"{channel:<14} {month:<8} {rows:>8}")
+    print(f"合計 {sum(totals.values())}件 / {len(totals)}パーティション")
+
+
+# アーカイブから下流のインデックスを再構築する（Slack・OpenAIは使わない）
+def import_archive(args):
+    # 絞り込んだ一部の行を公開すると全ワーカーがその部分集合だけで検索してしまう
+    if not args.no_publish and (args.channel or args.month):
+        raise SystemExit("--channel/--month 指定時は共有インデックスを公開できません（--no-publish を付けてください）")
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    import embeddings
+    from index_loader import build_and_publish
+    import shared_index
+
+    logging.basicConfig(level=logging.INFO)
+    started = time.perf_counter()
+    index = load_index(
+        args.directory, model=embeddings.EMBEDDING_MODEL, dim=embeddings.EMBEDDING_DIM,
+        channels=args.channel, months=args.month,
+    )
+    print(f"[INFO] アーカイブ読み込み: {len(index)}件 ({time.perf_counter() - started:.2f}s)")
+
+    if not args.no_publish:
+        directory = args.shared_directory or os.getenv("SHARED_INDEX_DIR") or shared_index.default_directory()
+        # アーカイブは取り込み済みの全行を持つとは限らない（seed前・モデル変更後など）
+        # 公開中より少ない行で差し替えると全ワーカーの検索対象が欠けるため、--force時のみ許可する
+        current = shared_index.read_manifest(directory)
+        current_rows = current["rows"] if current else 0
+        if not args.force and (not len(index) or len(index) < current_rows):
+            raise SystemExit(
+                f"アーカイブの行数({len(index)}件)が公開中のインデックス({current_rows}件)より少ないため公開しません"
+                "（seed でアーカイブを補うか、--force を付けてください）"
+            )
+        version = build_and_publish(directory, index=index)
+        print(f"[INFO] 共有検索インデックス公開: v{version} → {directory}")
+
+    if args.supabase:
+        from supabase import create_client
+
+        client = create_client(os.getenv("SUPABASE_URL"), os.getenv("SUPABASE_KEY"))
+        inserted = backfill_supabase(client, args.directory, channels=args.channel, months=args.month)
+        print(f"[INFO] Supabaseへ一括投入: {inserted}件")
+
+
+def seed(args):
+    from dotenv import load_dotenv
+    from supabase import create_client
+
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO)
+    client = create_client(os.getenv("SUPABASE_URL"), os.getenv("SUPABASE_KEY"))
+    written = seed_from_supabase(client, args.directory)
+    print(f"[INFO] slack_messagesからアーカイブへ取り込み: {written}件")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="メッセージアーカイブの確認・インポート")
+    parser.add_argument("--directory", default=None, help="アーカイブのディレクトリ（既定: ARCHIVE_DIR または archive）")
+    parser.add_argument("--channel", action="append", help="対象チャンネルID（複数指定可）")
+    parser.add_argument("--month", action="append", help="対象月 YYYY-MM（複数指定可）")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    sub.add_parser("stats", help="パーティションごとの件数").set_defaults(func=stats)
+
+    import_parser = sub.add_parser("import", help="アーカイブから検索インデックス等を再構築")
+    import_parser.add_argument("--shared-directory", help="共有インデックスの公開先（既定: SHARED_INDEX_DIR）")
+    import_parser.add_argument("--no-publish", action="store_true", help="共有検索インデックスを公開しない")
+    import_parser.add_argument("--supabase", action="store_true", help="Supabaseに無い行を一括投入する")
+    import_parser.add_argument("--force", action="store_true", help="公開中のインデックスより行数が少なくても公開する")
+    import_parser.set_defaults(func=import_archive)
+
+    sub.add_parser("seed", help="slack_messagesの既存行をアーカイブに取り込む").set_defaults(func=seed)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
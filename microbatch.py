@@ -0,0 +1,64 @@
+import time
+import queue
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class MicroBatcher:
+    """同時に届いたリクエストを短い待ち時間でまとめ、バッチ関数を1回だけ呼び出す
+
+    batch_func はアイテムのリストを受け取り、同じ順序・同じ件数の結果リストを返すこと。
+    バッチは最大 max_in_flight 本まで並行に実行し、実行中も次のバッチを集め続ける
+    （上流の応答が遅くても、後から届いたリクエストが前のバッチの完了を待たない）。
+    """
+
+    def __init__(self, batch_func, max_batch=32, window_ms=5, name="microbatch", max_in_flight=4):
+        self.batch_func = batch_func
+        self.max_batch = max_batch
+        self.window = window_ms / 1000.0
+        self._queue = queue.Queue()
+        self._slots = threading.Semaphore(max_in_flight)
+        self._executor = ThreadPoolExecutor(max_in_flight, thread_name_prefix=name)
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    # アイテムを投入し、結果を待つ
+    def submit(self, item, timeout=None):
+        future = Future()
+        self._queue.put((item, future))
+        return future.result(timeout=timeout)
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            # 実行中のバッチが上限に達している間は、届いたアイテムを次のバッチとして溜めておく
+            self._slots.acquire()
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._executor.submit(self._process, batch)
+
+    def _process(self, batch):
+        items = [item for item, _ in batch]
+        try:
+            results = self.batch_func(items)
+            if len(results) != len(items):
+                raise ValueError(f"バッチ結果の件数不一致: {len(results)} != {len(items)}")
+        except Exception as e:
+            logger.error(f"バッチ処理失敗 ({len(items)}件): {e}")
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        finally:
+            self._slots.release()
+        for (_, future), result in zip(batch, results):
+            future.set_result(result)
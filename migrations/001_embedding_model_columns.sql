@@ -0,0 +1,10 @@
+-- 埋め込みモデル・次元を行ごとに記録し、次元縮小(256/512など)したベクトルも保存できるようにする
+alter table slack_messages add column if not exists embedding_model text;
+alter table slack_messages add column if not exists embedding_dim integer;
+
+-- 次元固定の vector(1536) を次元可変の vector に変更
+alter table slack_messages alter column embedding type vector using embedding::vector;
+
+-- 再埋め込みジョブ・インデックス読み込みの絞り込み用
+create index if not exists slack_messages_embedding_version_idx
+    on slack_messages (embedding_model, embedding_dim, id);
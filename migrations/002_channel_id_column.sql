@@ -0,0 +1,6 @@
+-- メッセージの投稿チャンネルを記録し、検索インデックスのchannel_idでの絞り込み・シャード分割に使う
+alter table slack_messages add column if not exists channel_id text;
+
+-- 既存行は slack_to_supabase.py の次回実行時に（既に取り込み済みのメッセージとして）channel_idが補完される
+create index if not exists slack_messages_channel_id_idx
+    on slack_messages (channel_id, id);
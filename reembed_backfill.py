@@ -0,0 +1,148 @@
+"""slack_messages全件を1つの埋め込みモデル・次元に揃える再埋め込みジョブ
+
+中断しても --checkpoint のファイルから再開できる。対象モデル・次元で
+埋め込み済みの行はスキップするため、何度実行しても結果は同じになる。
+
+使い方:
+    python reembed_backfill.py --dimensions 512 --workers 4
+    python reembed_backfill.py --reset   # チェックポイントを破棄して最初から
+
+事前に migrations/001_embedding_model_columns.sql を適用しておくこと。
+"""
+import os
+import json
+import time
+import random
+import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+from supabase import create_client
+from openai import OpenAI
+import embeddings
+
+load_dotenv()
+
+SUPABASE_URL = os.getenv("SUPABASE_URL")
+SUPABASE_KEY = os.getenv("SUPABASE_KEY")
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+
+TABLE = "slack_messages"
+MAX_ATTEMPTS = 5
+
+
+def load_checkpoint(path, model, dimensions):
+    if not os.path.exists(path):
+        return {"model": model, "dimensions": dimensions, "last_id": 0, "done": 0}
+    with open(path, encoding="utf-8") as f:
+        checkpoint = json.load(f)
+    if checkpoint.get("model") != model or checkpoint.get("dimensions") != dimensions:
+        raise SystemExit(
+            f"チェックポイントのモデル/次元({checkpoint.get('model')}/{checkpoint.get('dimensions')})が"
+            f"指定と異なります。--reset で破棄してください"
+        )
+    return checkpoint
+
+
+# 一時ファイル経由で置き換え、途中で落ちても壊れたチェックポイントを残さない
+def save_checkpoint(path, checkpoint):
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp, path)
+
+
+# 未移行の行をidの昇順にbatch_size件ずつ取得
+def fetch_pending(supabase, after_id, model, dimensions, batch_size):
+    res = (
+        supabase.table(TABLE)
+        .select("id, message_text")
+        .gt("id", after_id)
+        .or_(f"embedding_model.is.null,embedding_model.neq.{model},embedding_dim.is.null,embedding_dim.neq.{dimensions}")
+        .order("id")
+        .limit(batch_size)
+        .execute()
+    )
+    return res.data or []
+
+
+# 指数バックオフ+ジッターで再試行
+def with_retries(func, *args, **kwargs):
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            if attempt == MAX_ATTEMPTS:
+                raise
+            delay = min(30.0, 2 ** attempt) * random.uniform(0.5, 1.0)
+            print(f"[WARN] 再試行 {attempt}/{MAX_ATTEMPTS - 1} ({delay:.1f}s後): {e}")
+            time.sleep(delay)
+
+
+# 1バッチ分を1回のAPI呼び出しで埋め込み、各行を更新
+def process_batch(supabase, openai_client, rows, model, dimensions):
+    vectors = with_retries(
+        embeddings.embed_texts, openai_client, [row["message_text"] for row in rows],
+        model=model, dimensions=dimensions,
+    )
+    metadata = embeddings.embedding_metadata(model, dimensions)
+    for row, vector in zip(rows, vectors):
+        with_retries(
+            lambda: supabase.table(TABLE).update({"embedding": vector, **metadata}).eq("id", row["id"]).execute()
+        )
+    return len(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="slack_messagesの再埋め込み")
+    parser.add_argument("--model", default=embeddings.EMBEDDING_MODEL)
+    parser.add_argument("--dimensions", type=int, default=embeddings.EMBEDDING_DIM)
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--checkpoint", default="reembed_checkpoint.json")
+    parser.add_argument("--reset", action="store_true", help="チェックポイントを破棄して最初から実行")
+    args = parser.parse_args()
+
+    if not SUPABASE_URL or not SUPABASE_KEY or not OPENAI_API_KEY:
+        raise ValueError("環境変数(SUPABASE_URL, SUPABASE_KEY, OPENAI_API_KEY)が不足しています")
+
+    if args.reset and os.path.exists(args.checkpoint):
+        os.remove(args.checkpoint)
+    checkpoint = load_checkpoint(args.checkpoint, args.model, args.dimensions)
+
+    supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
+    openai_client = OpenAI(api_key=OPENAI_API_KEY)
+
+    print(f"[INFO] 再埋め込み開始: model={args.model} dim={args.dimensions} 再開位置 id>{checkpoint['last_id']}")
+    started = time.time()
+    processed = 0
+    cursor = checkpoint["last_id"]
+    # (最終id, future) を投入順に保持し、先頭から連続して完了した分だけチェックポイントを進める
+    in_flight = deque()
+    exhausted = False
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        while True:
+            while not exhausted and len(in_flight) < args.workers * 2:
+                rows = fetch_pending(supabase, cursor, args.model, args.dimensions, args.batch_size)
+                if not rows:
+                    exhausted = True
+                    break
+                cursor = rows[-1]["id"]
+                future = pool.submit(process_batch, supabase, openai_client, rows, args.model, args.dimensions)
+                in_flight.append((cursor, future))
+            if not in_flight:
+                break
+            last_id, future = in_flight.popleft()
+            count = future.result()
+            processed += count
+            checkpoint["done"] += count
+            checkpoint["last_id"] = last_id
+            save_checkpoint(args.checkpoint, checkpoint)
+            rate = processed / max(time.time() - started, 1e-6)
+            print(f"[INFO] {checkpoint['done']}件完了 (id<={last_id}, {rate:.1f}件/s)")
+
+    print(f"[INFO] 再埋め込み完了: {checkpoint['done']}件")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+"""外部API呼び出しの時間予算・リトライ・ヘッジ・サーキットブレーカー
+
+1件のメンション処理全体に Deadline（残り時間）を持たせ、各呼び出しの
+タイムアウトは「呼び出しごとの上限」と「残り時間」の小さい方にする。
+リトライは残り時間に収まる場合だけ、ジッター付きの指数バックオフで行う。
+上流ごとのサーキットブレーカーが開いている間は呼び出さずに即座に失敗させ、
+呼び出し側で劣化モード（語彙検索・キャッシュ・短い回答）に切り替える。
+"""
+import time
+import random
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+import tracing
+
+logger = logging.getLogger(__name__)
+
+
+class DeadlineExceeded(TimeoutError):
+    """時間予算を使い切った"""
+
+
+class CircuitOpenError(RuntimeError):
+    """サーキットブレーカーが開いているため呼び出さなかった"""
+
+
+class Deadline:
+    """処理全体の締め切り（time.monotonic基準）"""
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self):
+        return max(0.0, self.expires_at - time.monotonic())
+
+    @property
+    def expired(self):
+        return self.remaining() <= 0
+
+    # 1回の呼び出しに使えるタイムアウト（reserve秒は後続処理のために残す）
+    def timeout(self, cap=None, reserve=0.0):
+        remaining = self.remaining() - reserve
+        if remaining <= 0:
+            raise DeadlineExceeded(f"時間予算切れ (予算{self.seconds}s)")
+        return remaining if cap is None else min(cap, remaining)
+
+
+class CircuitBreaker:
+    """連続failure_threshold回失敗で開き、reset_seconds後に1回だけ試行を通す"""
+
+    def __init__(self, name, failure_threshold=5, reset_seconds=30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = "closed"
+        self.failures = 0
+        self._opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and time.monotonic() - self._opened_at >= self.reset_seconds:
+                self.state = "half_open"
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            if self.state != "closed":
+                logger.info(f"サーキットブレーカー復帰: {self.name}")
+            self.state = "closed"
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                if self.state != "open":
+                    logger.warning(f"サーキットブレーカー遮断: {self.name} (連続失敗{self.failures}回)")
+                self.state = "open"
+                self._opened_at = time.monotonic()
+
+    def status(self):
+        return {"state": self.state, "failures": self.failures}
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+# 上流ごとのブレーカー（同じ名前には同じインスタンスを返す）
+def get_breaker(name, failure_threshold=5, reset_seconds=30.0):
+    with _breakers_lock:
+        breaker = _breakers.get(name)
+        if breaker is None:
+            breaker = _breakers[name] = CircuitBreaker(name, failure_threshold, reset_seconds)
+        return breaker
+
+
+def breaker_status():
+    with _breakers_lock:
+        return {name: breaker.status() for name, breaker in _breakers.items()}
+
+
+# func(timeout)を残り時間内でリトライする（retryable(e)がFalseの例外は即座に送出）
+def call_with_retries(func, deadline, breaker=None, attempts=3, timeout_cap=None, reserve=0.0,
+                      base_delay=0.2, max_delay=2.0, retryable=None):
+    for attempt in range(attempts):
+        timeout = deadline.timeout(timeout_cap, reserve)
+        if breaker is not None and not breaker.allow():
+            raise CircuitOpenError(f"{breaker.name} は遮断中です")
+        try:
+            result = func(timeout)
+        except Exception as e:
+            transient = retryable is None or retryable(e)
+            # 入力不正など上流の障害ではない失敗はブレーカーに数えない
+            if breaker is not None:
+                if transient:
+                    breaker.record_failure()
+                else:
+                    breaker.record_success()
+            if attempt + 1 >= attempts or not transient:
+                raise
+            # フルジッター: 0〜base*2^attemptの一様乱数だけ待つ（残り時間を超える場合は諦める）
+            delay = random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+            if delay >= deadline.remaining() - reserve:
+                raise
+            logger.warning(f"リトライ {attempt + 1}/{attempts - 1}: {e!r} ({delay:.2f}s後)")
+            time.sleep(delay)
+            continue
+        if breaker is not None:
+            breaker.record_success()
+        return result
+
+
+_call_executor = None
+_call_executor_lock = threading.Lock()
+
+
+# ヘッジ・タイムアウト付き呼び出し用のスレッドプール（初回利用時に生成）
+def call_executor():
+    global _call_executor
+    with _call_executor_lock:
+        if _call_executor is None:
+            _call_executor = ThreadPoolExecutor(8, thread_name_prefix="upstream-call")
+    return _call_executor
+
+
+# タイムアウトを指定できない呼び出しを別スレッドで実行し、timeout秒で待つのをやめる
+def run_with_timeout(func, timeout):
+    future = call_executor().submit(tracing.bind(func))
+    try:
+        return future.result(timeout=timeout)
+    except FuturesTimeoutError:
+        raise DeadlineExceeded(f"{timeout:.1f}s以内に応答がありません") from None
+
+
+# func()をhedge_after秒以内に返らなければもう1本投げ、先に成功した方を返す
+# 負けた方の呼び出しはそれぞれのタイムアウトで打ち切られる
+def hedged(func, hedge_after):
+    if not hedge_after or hedge_after <= 0:
+        return func()
+    executor = call_executor()
+    func = tracing.bind(func)
+    futures = [executor.submit(func)]
+    done, _ = wait(futures, timeout=hedge_after)
+    if not done:
+        logger.info(f"ヘッジリクエスト送信 ({hedge_after * 1000:.0f}ms応答なし)")
+        futures.append(executor.submit(func))
+    pending = set(futures)
+    error = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                return future.result()
+            error = future.exception()
+    raise error
@@ -0,0 +1,135 @@
+"""複数ワーカープロセスで1つの検索インデックスを共有する
+
+ローダープロセスが正規化済みembedding行列を共有メモリ上のディレクトリ
+（既定は /dev/shm/mrvector）へバージョン付きで書き出し、manifest.json を
+アトミックに差し替えて公開する。各ワーカーは np.load(mmap_mode="r") で
+読み取り専用にマップするため、物理メモリ上の行列は全ワーカーで1つになる。
+manifestは行列の書き込み完了後にのみ更新されるので、書きかけの行列が見えることはない。
+"""
+import os
+import json
+import time
+import logging
+import tempfile
+import threading
+import numpy as np
+from vector_index import EmbeddingIndex
+
+logger = logging.getLogger(__name__)
+
+MANIFEST = "manifest.json"
+KEEP_VERSIONS = 2  # 差し替え直後も旧バージョンを読み込み中のワーカーがいるため1世代残す
+
+
+def default_directory():
+    base = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+    return os.path.join(base, "mrvector")
+
+
+def _atomic_write(path, write):
+    tmp = f"{path}.tmp.{os.getpid()}"
+    with open(tmp, "wb") as f:
+        write(f)
+    os.replace(tmp, path)
+
+
+def read_manifest(directory):
+    try:
+        with open(os.path.join(directory, MANIFEST), encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+# インデックスを新しいバージョンとして公開し、バージョン番号を返す
+def publish_index(index, directory=None, **info):
+    directory = directory or default_directory()
+    os.makedirs(directory, exist_ok=True)
+    previous = read_manifest(directory)
+    version = (previous["version"] + 1) if previous else 1
+    matrix_file = f"index-v{version}.npy"
+    records_file = f"index-v{version}.json"
+
+    matrix = np.ascontiguousarray(index.matrix, dtype=np.float32)
+    _atomic_write(os.path.join(directory, matrix_file), lambda f: np.save(f, matrix))
+    _atomic_write(
+        os.path.join(directory, records_file),
+        lambda f: f.write(json.dumps(index.records, ensure_ascii=False, default=str).encode("utf-8")),
+    )
+    manifest = {
+        "version": version,
+        "matrix": matrix_file,
+        "records": records_file,
+        "rows": len(index),
+        "dim": int(matrix.shape[1]) if matrix.ndim == 2 else 0,
+        "published_at": time.time(),
+        **info,
+    }
+    _atomic_write(
+        os.path.join(directory, MANIFEST),
+        lambda f: f.write(json.dumps(manifest).encode("utf-8")),
+    )
+    _remove_old_versions(directory, version)
+    logger.info(f"共有インデックス公開: v{version} ({len(index)}件)")
+    return version
+
+
+def _remove_old_versions(directory, current):
+    for name in os.listdir(directory):
+        if not name.startswith("index-v"):
+            continue
+        try:
+            version = int(name[len("index-v"):].split(".")[0])
+        except ValueError:
+            continue
+        # 既にマップ済みのワーカーはunlink後もそのまま読める
+        if version <= current - KEEP_VERSIONS:
+            try:
+                os.remove(os.path.join(directory, name))
+            except FileNotFoundError:
+                pass
+
+
+class SharedIndexReader:
+    """公開済みの最新バージョンを読み取り専用でマップする（ワーカー側）"""
+
+    def __init__(self, directory=None, wait_seconds=600, poll_seconds=0.5):
+        self.directory = directory or default_directory()
+        self.wait_seconds = wait_seconds
+        self.poll_seconds = poll_seconds
+        self.version = None
+        self.index = None
+        self._lock = threading.Lock()
+
+    # 最新バージョンのインデックスを返す（未変更なら前回と同じオブジェクト）
+    # vector_index.load_index_from_supabase と同じく progress(件数) を呼ぶ
+    def load(self, progress=None):
+        deadline = time.monotonic() + self.wait_seconds
+        with self._lock:
+            while True:
+                manifest = read_manifest(self.directory)
+                if manifest is not None and manifest["version"] == self.version:
+                    return self.index
+                if manifest is not None:
+                    try:
+                        index = self._attach(manifest)
+                    except FileNotFoundError:
+                        # manifest読み込み直後に次のバージョンへ差し替えられた。次回読み直す
+                        index = None
+                    if index is not None:
+                        self.version, self.index = manifest["version"], index
+                        if progress:
+                            progress(len(index))
+                        logger.info(f"共有インデックス読み込み: v{self.version} ({len(index)}件)")
+                        return index
+                if self.index is not None:
+                    return self.index
+                if time.monotonic() >= deadline:
+                    raise TimeoutError(f"共有インデックスが公開されません: {self.directory}")
+                time.sleep(self.poll_seconds)
+
+    def _attach(self, manifest):
+        matrix = np.load(os.path.join(self.directory, manifest["matrix"]), mmap_mode="r")
+        with open(os.path.join(self.directory, manifest["records"]), encoding="utf-8") as f:
+            records = json.load(f)
+        return EmbeddingIndex.from_normalized(matrix, records)
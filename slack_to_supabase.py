@@ -1,10 +1,12 @@
 import os
 import time
-import openai
 import requests
+from openai import OpenAI
 from supabase import create_client, Client
 from dotenv import load_dotenv
 from datetime import datetime
+import embeddings
+from message_archive import ArchiveWriter
 
 load_dotenv()
 
@@ -13,19 +15,15 @@ SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 
-openai.api_key = OPENAI_API_KEY
+openai_client = OpenAI(api_key=OPENAI_API_KEY)
 supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
 
 SLACK_API_BASE = "https://slack.com/api"
 HEADERS = {"Authorization": f"Bearer {SLACK_BOT_TOKEN}"}
 
-# OpenAIで埋め込みベクトルを取得
+# OpenAIで埋め込みベクトルを取得（Botの検索クエリと同じモデル・次元）
 def get_embedding(text):
-    response = openai.Embedding.create(
-        input=text,
-        model="text-embedding-ada-002"
-    )
-    return response["data"][0]["embedding"]
+    return embeddings.embed_texts(openai_client, [text])[0]
 
 def get_channels():
     url = f"{SLACK_API_BASE}/conversations.list"
@@ -41,11 +39,20 @@ def get_messages(channel_id, latest=None):
     resp = requests.get(url, headers=HEADERS, params=params)
     return resp.json().get("messages", [])
 
-def message_exists(ts):
-    res = supabase.table("slack_messages").select("id").eq("timestamp", datetime.fromtimestamp(float(ts.split('.')[0])).isoformat()).execute()
+def message_exists(ts, channel_id=None):
+    res = supabase.table("slack_messages").select("id, channel_id").eq("timestamp", datetime.fromtimestamp(float(ts.split('.')[0])).isoformat()).execute()
+    # channel_id列の追加前に取り込んだ行にはチャンネルを補完する（検索のチャンネル絞り込み用）
+    missing = [row["id"] for row in res.data if not row.get("channel_id")]
+    if channel_id and missing:
+        supabase.table("slack_messages").update({"channel_id": channel_id}).in_("id", missing).execute()
     return len(res.data) > 0
 
 def main():
+    # Supabaseに加えてローカルのアーカイブにも追記する（API無しでの再構築用）
+    with ArchiveWriter() as archive:
+        ingest(archive)
+
+def ingest(archive):
     channels = get_channels()
     for ch in channels:
         channel_id = ch["id"]
@@ -55,20 +62,27 @@ def main():
             if msg.get("type") != "message" or "text" not in msg:
                 continue
             ts = msg.get("ts")
-            if message_exists(ts):
+            if message_exists(ts, channel_id):
                 continue
             text = msg["text"]
             user_id = msg.get("user")
             dt = datetime.fromtimestamp(float(ts.split('.')[0])) if ts else None
             embedding = get_embedding(text)
             data = {
+                "channel_id": channel_id,
                 "message_text": text,
                 "user_id": user_id,
                 "timestamp": dt.isoformat() if dt else None,
                 "embedding": embedding,
+                **embeddings.embedding_metadata(),
                 "raw_json": msg
             }
-            supabase.table("slack_messages").insert(data).execute()
+            res = supabase.table("slack_messages").insert(data).execute()
+            archive.append({
+                **data,
+                "id": res.data[0].get("id") if res.data else None,
+                "ts": ts,
+            })
             print(f"[INFO] 追加: {text[:30]}...")
             time.sleep(0.5)  # OpenAI APIのレート制限対策
 
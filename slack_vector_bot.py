@@ -1,18 +1,29 @@
 import os
-import json
-import numpy as np
+import re
+import hmac
+import time
+
+# プロセス開始（モジュール読み込み開始）時刻。import→ready時間の計測に使う
+# 以降のimport（numpy・flask等）にかかる時間も含めるため、他のimportより先に記録する
+IMPORT_STARTED_AT = time.perf_counter()
+
+import threading
 from typing import List, Dict, Any
 from dotenv import load_dotenv
-from supabase import create_client, Client
-from openai import OpenAI
-from slack_bolt import App
-from slack_bolt.adapter.flask import SlackRequestHandler
 from flask import Flask, request, jsonify
-from slack_sdk import WebClient
-from slack_sdk.errors import SlackApiError
 import traceback
 import logging
-from datetime import datetime, timedelta
+from collections import OrderedDict
+import tracing
+from tracing import start_trace, span, record_span
+from microbatch import MicroBatcher
+from conversation_store import MemoryConversationStore, SQLiteConversationStore
+from shared_index import SharedIndexReader
+from vector_index import load_index_from_supabase, ShardedIndex, partition_fields
+from lexical_index import LexicalIndex
+from resilience import Deadline, call_with_retries, get_breaker, breaker_status, hedged, run_with_timeout
+import embeddings
+from context_builder import build_context, budget_history, count_message_tokens, get_encoder
 
 # ログ設定
 logging.basicConfig(level=logging.INFO)
@@ -26,109 +37,383 @@ SUPABASE_KEY = os.getenv("SUPABASE_KEY")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 SLACK_BOT_TOKEN = os.getenv("SLACK_BOT_TOKEN")
 SLACK_SIGNING_SECRET = os.getenv("SLACK_SIGNING_SECRET")
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")  # 管理用エンドポイント(/admin/*)の認証トークン
+INDEX_REFRESH_SECONDS = int(os.getenv("INDEX_REFRESH_SECONDS", "3600"))  # インデックス再読み込み間隔（0で無効）
+
+# 1件のメンション処理全体の時間予算と、上流ごとの呼び出しタイムアウト（秒）
+MENTION_BUDGET_SECONDS = float(os.getenv("MENTION_BUDGET_SECONDS", "20"))
+RETRIEVAL_BUDGET_SECONDS = float(os.getenv("RETRIEVAL_BUDGET_SECONDS", "6"))  # 埋め込み・検索に使える上限
+EMBEDDING_TIMEOUT_SECONDS = float(os.getenv("EMBEDDING_TIMEOUT_SECONDS", "3"))
+EMBEDDING_ATTEMPTS = int(os.getenv("EMBEDDING_ATTEMPTS", "3"))
+EMBEDDING_HEDGE_MS = float(os.getenv("EMBEDDING_HEDGE_MS", "800"))  # この時間応答がなければ2本目を投げる（0で無効）
+GENERATION_TIMEOUT_SECONDS = float(os.getenv("GENERATION_TIMEOUT_SECONDS", "15"))
+OPENAI_TIMEOUT_SECONDS = float(os.getenv("OPENAI_TIMEOUT_SECONDS", "30"))  # 呼び出し側で指定しない場合の上限
+SUPABASE_TIMEOUT_SECONDS = float(os.getenv("SUPABASE_TIMEOUT_SECONDS", "30"))
+SUPABASE_SCAN_TIMEOUT_SECONDS = float(os.getenv("SUPABASE_SCAN_TIMEOUT_SECONDS", "5"))
+# 残り時間がこれを切ったら短い回答にする／生成を諦めて関連メッセージのみ返す
+SHORT_ANSWER_BELOW_SECONDS = float(os.getenv("SHORT_ANSWER_BELOW_SECONDS", "8"))
+MIN_GENERATION_SECONDS = float(os.getenv("MIN_GENERATION_SECONDS", "2"))
+POSTING_RESERVE_SECONDS = float(os.getenv("POSTING_RESERVE_SECONDS", "2"))  # Slackへの投稿用に残す時間
+ANSWER_MAX_TOKENS = 800
+SHORT_ANSWER_MAX_TOKENS = int(os.getenv("SHORT_ANSWER_MAX_TOKENS", "250"))
+# 埋め込みAPIが使えない時の語彙検索（BM25）フォールバック
+LEXICAL_FALLBACK = os.getenv("LEXICAL_FALLBACK", "1") != "0"
+
+# 事前チェック（クライアント生成時に実行）
+def _require_env():
+    if not SUPABASE_URL or not SUPABASE_KEY or not OPENAI_API_KEY or not SLACK_BOT_TOKEN or not SLACK_SIGNING_SECRET:
+        raise ValueError("環境変数(SUPABASE_URL, SUPABASE_KEY, OPENAI_API_KEY, SLACK_BOT_TOKEN, SLACK_SIGNING_SECRET)が不足しています")
+
+# クライアントは初回利用時に生成する（起動時間短縮のため、重いライブラリのimportも遅延）
+_clients = {}
+_clients_lock = threading.RLock()
 
-# 事前チェック
-if not SUPABASE_URL or not SUPABASE_KEY or not OPENAI_API_KEY or not SLACK_BOT_TOKEN or not SLACK_SIGNING_SECRET:
-    raise ValueError("環境変数(SUPABASE_URL, SUPABASE_KEY, OPENAI_API_KEY, SLACK_BOT_TOKEN, SLACK_SIGNING_SECRET)が不足しています")
+def _lazy_client(name, factory):
+    client = _clients.get(name)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(name)
+            if client is None:
+                _require_env()
+                client = factory()
+                _clients[name] = client
+    return client
 
-# クライアント初期化
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
-openai_client = OpenAI(api_key=OPENAI_API_KEY)
-slack_client = WebClient(token=SLACK_BOT_TOKEN)
+def get_supabase():
+    def factory():
+        from supabase import create_client, ClientOptions
+        return create_client(SUPABASE_URL, SUPABASE_KEY, options=ClientOptions(postgrest_client_timeout=SUPABASE_TIMEOUT_SECONDS))
+    return _lazy_client("supabase", factory)
+
+def get_openai_client():
+    def factory():
+        from openai import OpenAI
+        # リトライは呼び出し側で残り時間を見て行う
+        return OpenAI(api_key=OPENAI_API_KEY, timeout=OPENAI_TIMEOUT_SECONDS, max_retries=0)
+    return _lazy_client("openai", factory)
+
+def get_slack_client():
+    def factory():
+        from slack_sdk import WebClient
+        # 投稿は時間予算のうち投稿用に確保した分で終える（SDK既定の接続エラー時リトライも無効化）
+        return WebClient(token=SLACK_BOT_TOKEN, timeout=POSTING_RESERVE_SECONDS, retry_handlers=[])
+    return _lazy_client("slack", factory)
+
+# Slack Bolt（auth.testは起動時に呼ばない）
+def get_bolt_handler():
+    def factory():
+        from slack_bolt import App
+        from slack_bolt.adapter.flask import SlackRequestHandler
+        app = App(
+            signing_secret=SLACK_SIGNING_SECRET,
+            client=get_slack_client(),
+            token_verification_enabled=False,
+        )
+        app.event("app_mention")(handle_mention)
+        return SlackRequestHandler(app)
+    return _lazy_client("bolt_handler", factory)
 
-# Slack Bolt/Flask
-app = App(token=SLACK_BOT_TOKEN, signing_secret=SLACK_SIGNING_SECRET)
 flask_app = Flask(__name__)
-handler = SlackRequestHandler(app)
 
-# ベクトル次元数
-EMBEDDING_DIM = 1536
+# 埋め込みモデル・ベクトル次元数（ingester/再埋め込みジョブと共通）
+EMBEDDING_MODEL = embeddings.EMBEDDING_MODEL
+EMBEDDING_DIM = embeddings.EMBEDDING_DIM
+
+# 検索候補数と、MMRで絞り込んだ後にプロンプトへ入れる件数
+SEARCH_CANDIDATES = int(os.getenv("SEARCH_CANDIDATES", "15"))
+CONTEXT_TOP_K = 5
+# 同時メンションをまとめる待ち時間（0でバッチ化しない）
+MENTION_BATCH_WINDOW_MS = float(os.getenv("MENTION_BATCH_WINDOW_MS", "5"))
+
+# 会話履歴ストア（CONVERSATION_DB指定時はSQLiteで複数ワーカー間共有、未指定時はメモリ内）
+CONVERSATION_DB = os.getenv("CONVERSATION_DB")
+
+def get_conversation_store():
+    def factory():
+        if CONVERSATION_DB:
+            return SQLiteConversationStore(CONVERSATION_DB)
+        return MemoryConversationStore()
+    return _lazy_client("conversation_store", factory)
+
+# 共有インデックスのディレクトリ（指定時はローダープロセスが公開したインデックスを読み取り専用で使う）
+SHARED_INDEX_DIR = os.getenv("SHARED_INDEX_DIR")
+SHARED_INDEX_POLL_SECONDS = float(os.getenv("SHARED_INDEX_POLL_SECONDS", "2"))
+
+# 検索インデックスのパーティション（カンマ区切り: month, channel_id。noneで分割しない）
+# channel_id を使う場合は migrations/002_channel_id_column.sql を適用しておくこと
+INDEX_PARTITION = partition_fields(os.getenv("INDEX_PARTITION", "month"))
+# 差分更新でheadシャードに溜まった行数がこれを超えたらcompactする
+HEAD_MAX_ROWS = int(os.getenv("HEAD_MAX_ROWS", "5000"))
+# 差分更新だけでは反映されない編集・削除を取り込むための全件再構築間隔
+INDEX_FULL_REBUILD_SECONDS = int(os.getenv("INDEX_FULL_REBUILD_SECONDS", "86400"))
+
+# 検索インデックスとウォームアップ状態
+search_index = None
+_loaded_index = None  # パーティション分割前の読み込み結果
+_last_loaded_id = None
+_last_full_build = 0.0
+lexical_index = None
+_lexical_source = None
+warmup_status = {"state": "cold", "stage": None, "rows_loaded": 0, "ready_seconds": None, "error": None}
+_warmup_lock = threading.Lock()
+_warmup_thread = None
+
+def _partitioned(index):
+    if not INDEX_PARTITION:
+        return index
+    return ShardedIndex.from_index(index, INDEX_PARTITION)
+
+# インデックスを構築して差し替える（loader未指定時はSupabaseから読み込む）
+def refresh_index(loader=None):
+    global search_index, _loaded_index, _last_loaded_id, _last_full_build
+
+    def progress(rows_loaded):
+        warmup_status["rows_loaded"] = rows_loaded
 
-# 会話履歴を保持する辞書（メモリ内）
-conversation_history = {}
+    started = time.perf_counter()
+    if loader is None:
+        index = load_index_from_supabase(
+            get_supabase(), model=EMBEDDING_MODEL, dim=EMBEDDING_DIM, progress=progress
+        )
+    else:
+        index = loader(progress)
+    if index is _loaded_index:  # 共有インデックスのバージョンが変わっていない
+        return search_index
+    _loaded_index = index
+    _last_loaded_id = max((r.get("id") or 0 for r in index.records), default=0)
+    _last_full_build = time.monotonic()
+    search_index = _partitioned(index)
+    logger.info(f"検索インデックス構築完了: {len(index)}件 ({time.perf_counter() - started:.2f}s)")
+    return search_index
+
+# 前回以降に追加された行だけを読み込み、headシャードに追加する
+def append_new_messages():
+    global _last_loaded_id
+    index = search_index
+    if not isinstance(index, ShardedIndex):
+        return refresh_index()
+    new = load_index_from_supabase(
+        get_supabase(), model=EMBEDDING_MODEL, dim=EMBEDDING_DIM, after_id=_last_loaded_id
+    )
+    if len(new):
+        index.add(new.matrix, new.records)
+        _last_loaded_id = max([_last_loaded_id or 0] + [r.get("id") or 0 for r in new.records])
+        logger.info(f"検索インデックス差分追加: {len(new)}件 (head={index.head_rows}件)")
+    if index.head_rows > HEAD_MAX_ROWS:
+        index.compact()
+        logger.info(f"headシャードをcompact: シャード数={len(index.shards)}")
+    return index
+
+# 語彙検索インデックスを読み込み済みの行から作り直す（差分追加分は次の全件再構築で反映）
+def refresh_lexical_index():
+    global lexical_index, _lexical_source
+    source = _loaded_index
+    if not LEXICAL_FALLBACK or source is None or source is _lexical_source:
+        return
+    started = time.perf_counter()
+    lexical_index = LexicalIndex(source.records)
+    _lexical_source = source
+    logger.info(f"語彙検索インデックス構築完了: {len(lexical_index)}件 ({time.perf_counter() - started:.2f}s)")
 
-# embedding生成
-def get_embedding(text):
+def _warmup(loader, refresh_seconds, prewarm_clients):
     try:
-        response = openai_client.embeddings.create(
-            input=[text],
-            model="text-embedding-3-small"
+        warmup_status.update(state="loading", stage="clients")
+        if prewarm_clients:
+            get_openai_client()
+            get_slack_client()
+            get_bolt_handler()
+            get_encoder()
+        warmup_status["stage"] = "index"
+        refresh_index(loader)
+        warmup_status.update(
+            state="ready",
+            stage=None,
+            ready_seconds=round(time.perf_counter() - IMPORT_STARTED_AT, 3),
         )
-        emb = response.data[0].embedding
-        if len(emb) != EMBEDDING_DIM:
-            logger.error(f"embedding次元数不一致: {len(emb)}")
-            return None
-        return emb
+        logger.info(f"ウォームアップ完了: import→ready {warmup_status['ready_seconds']}s")
+    except Exception as e:
+        warmup_status.update(state="failed", error=repr(e))
+        logger.error(f"ウォームアップ失敗: {e}\n{traceback.format_exc()}")
+        return
+    try:
+        refresh_lexical_index()
     except Exception as e:
-        logger.error(f"OpenAI埋め込み生成失敗: {e}")
-        return None
+        logger.error(f"語彙検索インデックス構築失敗: {e}")
+    # 定期的にインデックスを更新（Supabaseからの場合は差分追加、一定間隔で全件再構築）
+    # 失敗しても旧インデックスで継続
+    while refresh_seconds > 0:
+        time.sleep(refresh_seconds)
+        try:
+            if loader is None and time.monotonic() - _last_full_build < INDEX_FULL_REBUILD_SECONDS:
+                append_new_messages()
+            else:
+                refresh_index(loader)
+                refresh_lexical_index()
+        except Exception as e:
+            logger.error(f"インデックス再構築失敗: {e}")
+
+# バックグラウンドでウォームアップを開始（多重起動しない）
+def start_background_warmup(loader=None, refresh_seconds=None):
+    global _warmup_thread
+    with _warmup_lock:
+        idle = _warmup_thread is None or not _warmup_thread.is_alive()
+        if idle and warmup_status["state"] in ("cold", "failed"):
+            prewarm_clients = loader is None
+            if loader is None and SHARED_INDEX_DIR:
+                # 共有インデックスを読み取り専用で使い、新しいバージョンの公開を監視する
+                loader = _lazy_client("shared_index_reader", lambda: SharedIndexReader(SHARED_INDEX_DIR)).load
+                refresh_seconds = SHARED_INDEX_POLL_SECONDS if refresh_seconds is None else refresh_seconds
+            if refresh_seconds is None:
+                refresh_seconds = INDEX_REFRESH_SECONDS
+            _warmup_thread = threading.Thread(
+                target=_warmup, args=(loader, refresh_seconds, prewarm_clients), daemon=True
+            )
+            _warmup_thread.start()
+    return _warmup_thread
+
+def is_ready():
+    return warmup_status["state"] == "ready"
 
-# 改良されたSupabaseベクトル類似検索
-def search_similar_messages(query_embedding, top_k=5, min_similarity=0.3):
+# 複数クエリをまとめて検索（埋め込みAPI呼び出し1回＋行列積1回）し、クエリごとの上位k件を返す
+def search_many(queries, top_k=5, min_similarity=0.3):
+    if not queries:
+        return []
+    query_embeddings = embeddings.embed_texts(get_openai_client(), queries)
+    return _search_embeddings(query_embeddings, top_k, min_similarity)
+
+def _search_embeddings(query_embeddings, top_k, min_similarity, deadline=None):
+    index = search_index
+    if index is None:
+        return _scan_supabase_within(query_embeddings, top_k, min_similarity, deadline)
     try:
-        # 直接的なクエリでベクトル検索
-        res = supabase.table("slack_messages").select("message_text, user_id, timestamp, embedding, raw_json").execute()
-        
-        if not res.data:
+        return index.search_many(query_embeddings, top_k=top_k, min_similarity=min_similarity, with_vectors=True)
+    except Exception as e:
+        logger.error(f"インデックス検索失敗: {e}")
+        return [[] for _ in query_embeddings]
+
+# OpenAIの一時的な障害（タイムアウト・接続エラー・429・5xx）ならTrue
+def _is_transient(e):
+    import openai
+    if isinstance(e, openai.APIStatusError):
+        return e.status_code in (408, 409, 429) or e.status_code >= 500
+    return isinstance(e, (openai.APIConnectionError, TimeoutError))
+
+# 時間予算内で埋め込みを取得（遅い応答にはヘッジ、一時的な失敗はリトライ）
+def embed_queries(texts, deadline):
+    client = get_openai_client()
+
+    def attempt(timeout):
+        return hedged(lambda: embeddings.embed_texts(client, texts, timeout=timeout), EMBEDDING_HEDGE_MS / 1000)
+
+    return call_with_retries(
+        attempt, deadline, breaker=get_breaker("openai.embedding"), attempts=EMBEDDING_ATTEMPTS,
+        timeout_cap=EMBEDDING_TIMEOUT_SECONDS, retryable=_is_transient,
+    )
+
+# 同時に届いたメンションの埋め込み・検索をまとめて実行（MicroBatcherのバッチ関数）
+# アイテムは(質問文, Deadline, Trace)。期限の早いメンションは呼び出し側が先に待つのをやめるので、最も遅い期限に合わせる
+# バッチ処理中はこのスレッドを各メンションのトレースに結びつける（プロファイル対象にする）
+def _embed_and_search_batch(items):
+    texts = [text for text, _, _ in items]
+    deadline = max((d for _, d, _ in items), key=lambda d: d.expires_at)
+    traces = [trace for _, _, trace in items]
+    with tracing.attach(*traces):
+        started = time.perf_counter()
+        query_embeddings = embed_queries(texts, deadline)
+        embedded = time.perf_counter()
+        results = _search_embeddings(query_embeddings, SEARCH_CANDIDATES, 0.3, deadline)
+    timing = {"started": started, "embedded": embedded, "searched": time.perf_counter(), "batch_size": len(texts)}
+    return [(similar_messages, timing) for similar_messages in results]
+
+def embed_and_search(text, deadline=None):
+    deadline = deadline or Deadline(RETRIEVAL_BUDGET_SECONDS)
+    item = (text, deadline, tracing.current_trace())
+    if MENTION_BATCH_WINDOW_MS <= 0:
+        return _embed_and_search_batch([item])[0]
+    batcher = _lazy_client(
+        "mention_batcher",
+        lambda: MicroBatcher(_embed_and_search_batch, max_batch=32, window_ms=MENTION_BATCH_WINDOW_MS, name="mention-batcher"),
+    )
+    return batcher.submit(item, timeout=deadline.timeout())
+
+# 直近の検索結果（埋め込みAPIが使えない間、同じ質問に再利用する）
+RESULT_CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", "256"))
+_result_cache = OrderedDict()
+_result_cache_lock = threading.Lock()
+
+def _query_key(text):
+    return re.sub(r"<@[^>]+>", "", text or "").strip()
+
+def remember_results(text, results):
+    with _result_cache_lock:
+        _result_cache[_query_key(text)] = results
+        _result_cache.move_to_end(_query_key(text))
+        while len(_result_cache) > RESULT_CACHE_SIZE:
+            _result_cache.popitem(last=False)
+
+# 埋め込み検索ができない時の代替（直近の同じ質問の結果 → 語彙検索 → なし）と、その種別を返す
+def fallback_search(text):
+    query = _query_key(text)
+    with _result_cache_lock:
+        cached = _result_cache.get(query)
+    if cached is not None:
+        return cached, "cache"
+    lexical = lexical_index
+    if lexical is not None:
+        return [{**r, "similarity": 0.0} for r in lexical.search(query, top_k=SEARCH_CANDIDATES)], "lexical"
+    return [], "none"
+
+# Supabase全件スキャンを時間予算内に打ち切る（タイムアウト・遮断中は結果なし）
+def _scan_supabase_within(query_embeddings, top_k, min_similarity, deadline=None):
+    if deadline is None:
+        return _scan_supabase(query_embeddings, top_k, min_similarity)
+    try:
+        return call_with_retries(
+            lambda timeout: run_with_timeout(lambda: _scan_supabase(query_embeddings, top_k, min_similarity), timeout),
+            deadline, breaker=get_breaker("supabase"), attempts=1,
+            timeout_cap=SUPABASE_SCAN_TIMEOUT_SECONDS,
+        )
+    except Exception as e:
+        logger.error(f"Supabaseベクトル検索打ち切り: {e}")
+        return [[] for _ in query_embeddings]
+
+# インデックス未構築時の検索（Supabaseから1回だけ読み込み、全クエリを行列積1回で採点する）
+def _scan_supabase(query_embeddings, top_k=5, min_similarity=0.3):
+    try:
+        with span("retrieval.fetch") as fetch_span:
+            index = load_index_from_supabase(get_supabase(), model=EMBEDDING_MODEL, dim=EMBEDDING_DIM)
+            fetch_span["rows"] = len(index)
+        if not len(index):
             logger.warning("データベースにメッセージがありません")
-            return []
-        
-        # Pythonでコサイン類似度を計算
-        def cosine_similarity(a, b):
-            a = np.array(a, dtype=float)
-            b = np.array(b, dtype=float)
-            return np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b))
-        
-        # 各メッセージの類似度を計算
-        messages_with_similarity = []
-        for msg in res.data:
-            if msg.get('embedding'):
-                try:
-                    # embeddingが文字列の場合はJSONとしてパース
-                    if isinstance(msg['embedding'], str):
-                        embedding = json.loads(msg['embedding'])
-                    else:
-                        embedding = msg['embedding']
-                    
-                    # 数値配列に変換
-                    embedding = [float(x) for x in embedding]
-                    
-                    similarity = cosine_similarity(query_embedding, embedding)
-                    
-                    # 類似度が閾値を超える場合のみ追加
-                    if similarity >= min_similarity:
-                        messages_with_similarity.append({
-                            **msg,
-                            'similarity': similarity
-                        })
-                except Exception as e:
-                    logger.error(f"embedding処理エラー: {e}")
-                    continue
-        
-        # 類似度でソート
-        messages_with_similarity.sort(key=lambda x: x['similarity'], reverse=True)
-        
-        # 上位k件を返す
-        return messages_with_similarity[:top_k]
-        
+            return [[] for _ in query_embeddings]
+        with span("retrieval.score", candidates=len(index), queries=len(query_embeddings)):
+            return index.search_many(query_embeddings, top_k=top_k, min_similarity=min_similarity, with_vectors=True)
     except Exception as e:
         logger.error(f"Supabaseベクトル検索失敗: {e}")
-        return []
+        return [[] for _ in query_embeddings]
+
+# 回答生成が時間内に終わらない・使えない時は、関連する過去メッセージをそのまま返す
+def _fallback_answer(selected):
+    if not selected:
+        return "回答生成中にエラーが発生しました。"
+    lines = [f"• {(msg.get('message_text') or '')[:200]}" for msg in selected]
+    return "ただいま回答の生成に時間がかかっているため、関連しそうな過去メッセージをお送りします：\n" + "\n".join(lines)
 
 # 改良された要約・回答生成（会話履歴対応）
-def generate_answer(user_query, similar_messages, conversation_key=None):
+# 残り時間が少ない場合は参考メッセージを減らして短く答え、生成できなければ関連メッセージのみ返す
+def generate_answer(user_query, similar_messages, conversation_key=None, deadline=None):
+    deadline = deadline or Deadline(MENTION_BUDGET_SECONDS)
     try:
         # 会話履歴を取得
-        history = conversation_history.get(conversation_key, []) if conversation_key else []
-        
-        # 類似メッセージの詳細情報を構築
-        context_parts = []
-        if similar_messages:
-            for i, msg in enumerate(similar_messages, 1):
-                similarity = msg.get('similarity', 0)
-                context_parts.append(f"{i}. 類似度: {similarity:.3f} - {msg['message_text']}")
+        history = get_conversation_store().get(conversation_key) if conversation_key else []
+        short = deadline.remaining() - POSTING_RESERVE_SECONDS < SHORT_ANSWER_BELOW_SECONDS
         
-        context = "\n".join(context_parts) if context_parts else "関連する過去メッセージが見つかりませんでした。"
+        # 類似メッセージから重複を除き、トークン予算内でコンテキストを構築
+        with span("context") as context_span:
+            selected, context, context_tokens = build_context(similar_messages or [], top_k=3 if short else CONTEXT_TOP_K)
+            context_span.update(candidates=len(similar_messages or []), selected=len(selected), tokens=context_tokens)
+        if not context:
+            context = "関連する過去メッセージが見つかりませんでした。"
         
         # 会話履歴を含むプロンプト構築
         system_prompt = """あなたはSlackの社内AIアシスタント「Mr.Vector」です。
@@ -137,10 +422,9 @@ def generate_answer(user_query, similar_messages, conversation_key=None):
 
         messages = [{"role": "system", "content": system_prompt}]
         
-        # 会話履歴を追加
-        for hist in history[-5:]:  # 最新5件の履歴のみ使用
-            if hist["role"] in ["user", "assistant"]:
-                messages.append({"role": hist["role"], "content": hist["content"]})
+        # 会話履歴を追加（最新5件のうちトークン予算に収まる分のみ）
+        history_messages, history_tokens = budget_history(history)
+        messages.extend(history_messages)
         
         # 現在の質問とコンテキスト
         user_content = f"""以下の過去メッセージを参考に質問に答えてください：
@@ -154,36 +438,47 @@ def generate_answer(user_query, similar_messages, conversation_key=None):
 回答は自然で親しみやすい日本語で、Mr.Vectorとして回答してください。"""
         
         messages.append({"role": "user", "content": user_content})
-        
-        response = openai_client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=messages,
-            max_tokens=800,
-            temperature=0.7
+        prompt_tokens = count_message_tokens(messages)
+        logger.info(
+            f"プロンプトトークン数: {prompt_tokens} "
+            f"(context={context_tokens}, history={history_tokens}, 履歴{len(history_messages)}件)"
         )
         
+        max_tokens = SHORT_ANSWER_MAX_TOKENS if short else ANSWER_MAX_TOKENS
+        with span("generation", model="gpt-3.5-turbo", prompt_tokens_estimated=prompt_tokens,
+                  context_tokens=context_tokens, history_tokens=history_tokens, max_tokens=max_tokens) as gen_span:
+            try:
+                if deadline.remaining() - POSTING_RESERVE_SECONDS < MIN_GENERATION_SECONDS:
+                    raise TimeoutError("回答生成に使える時間が残っていません")
+                response = call_with_retries(
+                    lambda timeout: get_openai_client().chat.completions.create(
+                        model="gpt-3.5-turbo",
+                        messages=messages,
+                        max_tokens=max_tokens,
+                        temperature=0.7,
+                        timeout=timeout,
+                    ),
+                    deadline, breaker=get_breaker("openai.chat"), attempts=2,
+                    timeout_cap=GENERATION_TIMEOUT_SECONDS, reserve=POSTING_RESERVE_SECONDS,
+                    retryable=_is_transient,
+                )
+            except Exception as e:
+                gen_span["fallback"] = repr(e)
+                logger.warning(f"回答生成を打ち切り、関連メッセージのみ返します: {e}")
+                return _fallback_answer(selected)
+            if getattr(response, "usage", None):
+                gen_span["prompt_tokens"] = response.usage.prompt_tokens
+                gen_span["completion_tokens"] = response.usage.completion_tokens
+        
         if response.choices and response.choices[0].message and response.choices[0].message.content:
             answer = response.choices[0].message.content.strip()
             
-            # 会話履歴に追加
+            # 会話履歴に追加（長すぎる場合はストア側で古いものを削除）
             if conversation_key:
-                if conversation_key not in conversation_history:
-                    conversation_history[conversation_key] = []
-                
-                conversation_history[conversation_key].append({
-                    "role": "user",
-                    "content": user_query,
-                    "timestamp": datetime.now()
-                })
-                conversation_history[conversation_key].append({
-                    "role": "assistant",
-                    "content": answer,
-                    "timestamp": datetime.now()
-                })
-                
-                # 履歴が長すぎる場合は古いものを削除
-                if len(conversation_history[conversation_key]) > 20:
-                    conversation_history[conversation_key] = conversation_history[conversation_key][-10:]
+                get_conversation_store().append(conversation_key, [
+                    {"role": "user", "content": user_query},
+                    {"role": "assistant", "content": answer},
+                ])
             
             return answer
         else:
@@ -193,49 +488,77 @@ def generate_answer(user_query, similar_messages, conversation_key=None):
         logger.error(f"OpenAI要約生成失敗: {e}")
         return "回答生成中にエラーが発生しました。"
 
-# 改良されたSlackメンションイベント
-@app.event("app_mention")
+# Slackへの投稿（ソケット操作ごとのタイムアウトが重なっても POSTING_RESERVE_SECONDS 以上は待たない）
+def post_reply(**kwargs):
+    return run_with_timeout(lambda: get_slack_client().chat_postMessage(**kwargs), POSTING_RESERVE_SECONDS)
+
+# 改良されたSlackメンションイベント（Bolt生成時に登録）
 def handle_mention(event, say):
+    channel = event.get("channel")
+    thread_ts = event.get("thread_ts") or event.get("ts")  # スレッド内かどうか判定
+    with start_trace("app_mention", channel=channel, thread_ts=thread_ts) as trace:
+        _handle_mention(event, trace)
+
+def _handle_mention(event, trace):
     try:
         user = event["user"]
         text = event["text"]
         channel = event["channel"]
         thread_ts = event.get("thread_ts") or event.get("ts")  # スレッド内かどうか判定
-        logger.info(f"メンション受信: user={user}, text={text}, thread_ts={thread_ts}")
+        logger.info(f"メンション受信: trace_id={trace.trace_id}, user={user}, thread_ts={thread_ts}")
 
         # 会話キーを生成（チャンネル+スレッド）
         conversation_key = f"{channel}_{thread_ts}"
 
-        # embedding生成
-        embedding = get_embedding(text)
-        if embedding is None:
-            # スレッド内で返信
-            slack_client.chat_postMessage(
-                channel=channel,
-                thread_ts=thread_ts,
-                text="embedding生成に失敗しました。"
-            )
-            return
+        # メンション全体の時間予算（各呼び出しのタイムアウト・リトライはこの残り時間内に収める）
+        # 検索段階には、回答生成と投稿に最低限必要な時間を残した別の上限を設ける
+        deadline = Deadline(MENTION_BUDGET_SECONDS)
+        retrieval_deadline = Deadline(min(
+            RETRIEVAL_BUDGET_SECONDS, deadline.remaining() - MIN_GENERATION_SECONDS - POSTING_RESERVE_SECONDS
+        ))
 
-        # 類似検索（精度向上のため上位5件、類似度0.3以上）
-        similar_messages = search_similar_messages(embedding, top_k=5, min_similarity=0.3)
+        # embedding生成・類似検索（同時に届いたメンションとまとめて実行）
+        # 類似度0.3以上の候補を多めに取得し、生成時にMMRで5件に絞る
+        submitted = time.perf_counter()
+        try:
+            similar_messages, timing = embed_and_search(text, retrieval_deadline)
+        except Exception as e:
+            # 失敗までにかかった時間も内訳に残す（遅いリクエストの大半はここで時間を使う）
+            record_span("embedding", submitted, time.perf_counter(), error=repr(e))
+            # 埋め込みAPIの遅延・障害時は直近の検索結果か語彙検索で続行する
+            with span("retrieval.fallback") as fallback_span:
+                similar_messages, mode = fallback_search(text)
+                fallback_span.update(mode=mode, hits=len(similar_messages), reason=repr(e))
+            trace.attrs["degraded"] = mode
+            logger.warning(f"埋め込み検索失敗のため代替検索({mode})で継続: trace_id={trace.trace_id} {e!r}")
+        else:
+            record_span("embedding", timing["started"], timing["embedded"], batch_size=timing["batch_size"])
+            record_span("retrieval", timing["embedded"], timing["searched"], hits=len(similar_messages))
+            remember_results(text, similar_messages)
         
         # 要約・生成
-        answer = generate_answer(text, similar_messages, conversation_key)
+        answer = generate_answer(text, similar_messages, conversation_key, deadline=deadline)
         
         # スレッド内で返信（Mr.Vectorとして）
-        slack_client.chat_postMessage(
-            channel=channel,
-            thread_ts=thread_ts,
-            text=answer,
-            username="Mr.Vector",  # 表示名をMr.Vectorに設定
-            icon_emoji=":robot_face:"  # ロボットアイコン
-        )
+        # 投稿自体の失敗ではエラーメッセージの投稿も失敗するので、記録だけして終える
+        try:
+            with span("posting"):
+                post_reply(
+                    channel=channel,
+                    thread_ts=thread_ts,
+                    text=answer,
+                    username="Mr.Vector",  # 表示名をMr.Vectorに設定
+                    icon_emoji=":robot_face:"  # ロボットアイコン
+                )
+        except Exception as e:
+            trace.error = repr(e)
+            logger.error(f"Slackへの投稿失敗: trace_id={trace.trace_id} {e!r}")
         
     except Exception as e:
-        logger.error(f"メンション処理失敗: {e}\n{traceback.format_exc()}")
+        trace.error = repr(e)
+        logger.error(f"メンション処理失敗: trace_id={trace.trace_id} {e}\n{traceback.format_exc()}")
         try:
-            slack_client.chat_postMessage(
+            post_reply(
                 channel=channel,
                 thread_ts=thread_ts,
                 text=f"エラーが発生しました: {e}",
@@ -245,21 +568,66 @@ def handle_mention(event, say):
         except:
             pass
 
-# ヘルスチェックエンドポイント
+# ヘルスチェックエンドポイント（liveness: プロセスが応答できればok）
 @flask_app.route("/", methods=["GET"])
+@flask_app.route("/healthz", methods=["GET"])
 def health_check():
     return jsonify({"status": "ok", "message": "Slack AI Bot is running"})
 
+# readiness: 検索インデックスのウォームアップ完了後のみ200を返す
+@flask_app.route("/readyz", methods=["GET"])
+def readiness_check():
+    start_background_warmup()
+    status = dict(warmup_status)
+    if not is_ready():
+        return jsonify({"status": "warming_up", **status}), 503
+    return jsonify({"status": "ready", "rows": len(search_index), "breakers": breaker_status(), **status})
+
+# 管理用トークンの検証（ADMIN_TOKEN未設定時は管理エンドポイント自体を無効化）
+def _is_admin(req):
+    if not ADMIN_TOKEN:
+        return False
+    return hmac.compare_digest(req.headers.get("Authorization", "").encode(), f"Bearer {ADMIN_TOKEN}".encode())
+
+# 次のN件のメンションをサンプリングプロファイリングする（件数・一覧は PROFILE_DIR を介して全ワーカーで共有）
+@flask_app.route("/admin/profile", methods=["GET", "POST"])
+def admin_profile():
+    if not _is_admin(request):
+        return jsonify({"error": "forbidden"}), 403
+    if request.method == "POST":
+        body = request.get_json(silent=True) or {}
+        try:
+            count = int(body.get("requests", request.args.get("requests", 1)))
+        except (TypeError, ValueError):
+            return jsonify({"error": "requests must be an integer"}), 400
+        tracing.profile_switch.arm(count)
+        logger.info(f"プロファイリング有効化: 次の{count}件")
+    return jsonify({
+        "remaining": tracing.profile_switch.remaining,
+        "profiles": tracing.profile_switch.recent(20),
+    })
+
 # Slackイベントエンドポイント
 @flask_app.route("/slack/events", methods=["POST"])
 def slack_events():
-    logger.info(f"Slackイベント受信: {request.json}")
-    if request.json and "challenge" in request.json:
-        challenge = request.json["challenge"]
-        logger.info(f"URL検証チャレンジ: {challenge}")
+    payload = request.get_json(silent=True) or {}
+    event = payload.get("event") or {}
+    # ペイロード全体ではなく要約のみをサンプリングして記録
+    tracing.log_event(
+        "slack_event",
+        type=payload.get("type"),
+        event_type=event.get("type"),
+        event_id=payload.get("event_id"),
+        channel=event.get("channel"),
+        retry_num=request.headers.get("X-Slack-Retry-Num"),
+    )
+    if "challenge" in payload:
+        challenge = payload["challenge"]
+        logger.info("URL検証チャレンジ受信")
         return jsonify({"challenge": challenge})
-    return handler.handle(request)
+    return get_bolt_handler().handle(request)
 
 if __name__ == "__main__":
+    start_background_warmup()
     port = int(os.environ.get("PORT", 3000))
     flask_app.run(host="0.0.0.0", port=port)
@@ -4,6 +4,8 @@ from supabase import create_client, Client
 from openai import OpenAI
 import json
 import numpy as np
+import embeddings
+from vector_index import load_index_from_supabase
 
 load_dotenv()
 
@@ -20,11 +22,7 @@ openai_client = OpenAI(api_key=OPENAI_API_KEY)
 def get_embedding(text):
     """テキストをベクトル化"""
     try:
-        response = openai_client.embeddings.create(
-            input=[text],
-            model="text-embedding-3-small"
-        )
-        return response.data[0].embedding
+        return embeddings.embed_texts(openai_client, [text])[0]
     except Exception as e:
         print(f"❌ 埋め込み生成失敗: {e}")
         return None
@@ -33,7 +31,13 @@ def search_similar_messages(query_embedding, top_k=3):
     """Supabaseでベクトル類似検索"""
     try:
         # 直接的なクエリでベクトル検索
-        res = supabase.table("slack_messages").select("message_text, user_id, timestamp, embedding, raw_json").execute()
+        res = (
+            supabase.table("slack_messages")
+            .select("message_text, user_id, timestamp, embedding, raw_json")
+            .eq("embedding_model", embeddings.EMBEDDING_MODEL)
+            .eq("embedding_dim", embeddings.EMBEDDING_DIM)
+            .execute()
+        )
         
         if not res.data:
             print("⚠️  データベースにメッセージがありません")
@@ -78,6 +82,26 @@ def search_similar_messages(query_embedding, top_k=3):
         print(f"❌ ベクトル検索失敗: {e}")
         return []
 
+def search_many(queries, top_k=3):
+    """複数の質問をまとめてベクトル化・検索（埋め込みAPI呼び出し1回＋行列積1回）"""
+    if not queries:
+        return [], []
+    try:
+        query_embeddings = embeddings.embed_texts(openai_client, queries)
+    except Exception as e:
+        print(f"❌ 埋め込み生成失敗: {e}")
+        return None, [[] for _ in queries]
+    try:
+        index = load_index_from_supabase(
+            supabase, model=embeddings.EMBEDDING_MODEL, dim=embeddings.EMBEDDING_DIM
+        )
+    except Exception as e:
+        print(f"❌ ベクトル検索失敗: {e}")
+        return query_embeddings, [[] for _ in queries]
+    if not len(index):
+        print("⚠️  データベースにメッセージがありません")
+    return query_embeddings, index.search_many(query_embeddings, top_k=top_k)
+
 def generate_answer(user_query, similar_messages):
     """類似メッセージを基に回答生成"""
     try:
@@ -125,21 +149,18 @@ def test_vector_search():
         "AIについて"
     ]
     
-    for i, question in enumerate(test_questions, 1):
+    # 1-2. 全質問をまとめてベクトル化・類似メッセージ検索
+    print("1. 質問文をまとめてベクトル化・検索中...")
+    query_embeddings, all_results = search_many(test_questions, top_k=3)
+    if query_embeddings is None:
+        print("❌ ベクトル化失敗")
+        return
+    print(f"✅ {len(test_questions)}件のベクトル化・検索完了 (次元数: {len(query_embeddings[0])})")
+    
+    for i, (question, similar_messages) in enumerate(zip(test_questions, all_results), 1):
         print(f"\n📝 テスト {i}: {question}")
         print("-" * 30)
         
-        # 1. 質問文をベクトル化
-        print("1. 質問文をベクトル化中...")
-        embedding = get_embedding(question)
-        if embedding is None:
-            print("❌ ベクトル化失敗")
-            continue
-        print(f"✅ ベクトル化完了 (次元数: {len(embedding)})")
-        
-        # 2. 類似メッセージ検索
-        print("2. 類似メッセージ検索中...")
-        similar_messages = search_similar_messages(embedding, top_k=3)
         if not similar_messages:
             print("❌ 類似メッセージなし")
             continue
@@ -0,0 +1,362 @@
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import logging
+import threading
+import contextvars
+from collections import Counter
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windowsではプロセス内の排他のみ
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# トレース/プロファイリング設定
+TRACE_LOG_PATH = os.getenv("TRACE_LOG_PATH")  # 未設定の場合はloggerへJSON行を出力
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0.1"))
+SLOW_REQUEST_MS = float(os.getenv("SLOW_REQUEST_MS", "5000"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))
+PROFILE_KEEP = int(os.getenv("PROFILE_KEEP", "50"))  # 残すプロファイル数（古いものから削除）
+
+# 現在処理中のトレース（スレッド/コンテキストごと）
+_current_trace = contextvars.ContextVar("current_trace", default=None)
+# 別スレッドでまとめて処理中のトレース（バッチ処理では複数になる）
+_attached_traces = contextvars.ContextVar("attached_traces", default=())
+
+_write_lock = threading.Lock()
+_span_logger = logging.getLogger("trace")
+
+
+# JSON行を1行出力
+def _emit(record):
+    line = json.dumps(record, ensure_ascii=False, default=str)
+    if TRACE_LOG_PATH:
+        with _write_lock:
+            with open(TRACE_LOG_PATH, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+    else:
+        _span_logger.info(line)
+
+
+def _sampled():
+    return random.random() < TRACE_SAMPLE_RATE
+
+
+class SamplingProfiler:
+    """指定スレッドのスタックを一定間隔でサンプリングし、flamegraph形式(folded)で保存する
+
+    リクエストを処理するスレッドに加え、attach()中のワーカースレッド（バッチ・上流呼び出し・
+    シャード走査）もサンプリングする。ワーカーのスタックは "[スレッド名]" を根に置く。
+    """
+
+    def __init__(self, thread_id, interval_ms=PROFILE_INTERVAL_MS):
+        self.thread_id = thread_id
+        self.threads = Counter({thread_id: 1})
+        self._threads_lock = threading.Lock()
+        self.interval = interval_ms / 1000.0
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def add_thread(self, thread_id):
+        with self._threads_lock:
+            self.threads[thread_id] += 1
+
+    def remove_thread(self, thread_id):
+        with self._threads_lock:
+            self.threads[thread_id] -= 1
+            if self.threads[thread_id] <= 0:
+                del self.threads[thread_id]
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            with self._threads_lock:
+                thread_ids = list(self.threads)
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for thread_id in thread_ids:
+                frame = frames.get(thread_id)
+                if frame is None:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                if thread_id != self.thread_id:
+                    stack.append(f"[{names.get(thread_id, thread_id)}]")
+                self.stacks[";".join(reversed(stack))] += 1
+
+    # Brendan Greggのflamegraph.pl / speedscopeで読める形式で書き出す
+    def dump(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        return path
+
+
+class ProfileSwitch:
+    """次のN件のリクエストだけプロファイリングを有効にするスイッチ
+
+    残り件数は PROFILE_DIR 内のファイルに置き、同じディレクトリを使う全ワーカープロセスで共有する
+    （gunicornのどのワーカーが有効化を受け付けても、全ワーカー合わせて次のN件が対象になる）。
+    """
+
+    def __init__(self, directory=PROFILE_DIR):
+        self.directory = directory
+        self.path = os.path.join(directory, ".armed")
+        self._lock = threading.Lock()
+
+    # 残り件数のファイルをプロセス間で排他して読み書きする
+    @contextmanager
+    def _locked(self):
+        with self._lock:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(self.path, "a+", encoding="utf-8") as f:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_EX)
+                f.seek(0)
+                yield f
+
+    @staticmethod
+    def _read(f):
+        try:
+            return int(f.read().strip() or 0)
+        except ValueError:
+            return 0
+
+    @staticmethod
+    def _write(f, count):
+        f.seek(0)
+        f.truncate()
+        if count > 0:
+            f.write(str(count))
+
+    def arm(self, count):
+        count = max(0, int(count))
+        with self._locked() as f:
+            self._write(f, count)
+        return count
+
+    def take(self):
+        # 未設定時（ファイルが空）はロックを取らずに返す
+        try:
+            if os.path.getsize(self.path) == 0:
+                return False
+        except OSError:
+            return False
+        with self._locked() as f:
+            remaining = self._read(f)
+            if remaining <= 0:
+                return False
+            self._write(f, remaining - 1)
+            return True
+
+    @property
+    def remaining(self):
+        try:
+            with self._locked() as f:
+                return self._read(f)
+        except OSError:
+            return 0
+
+    # 全ワーカーが書き出したプロファイル（新しい順）
+    def recent(self, limit=20):
+        try:
+            names = [n for n in os.listdir(self.directory) if n.endswith(".folded")]
+        except FileNotFoundError:
+            return []
+        paths = [os.path.join(self.directory, n) for n in names]
+        paths.sort(key=lambda p: os.path.getmtime(p) if os.path.exists(p) else 0, reverse=True)
+        return paths[:limit]
+
+    # 書き出したプロファイルのうち、PROFILE_KEEP件を超えた古いファイルを削除する
+    def record_dump(self, path):
+        for old in self.recent(limit=None)[max(1, PROFILE_KEEP):]:
+            try:
+                os.remove(old)
+            except FileNotFoundError:
+                pass
+
+
+profile_switch = ProfileSwitch()
+
+
+class Trace:
+    """1リクエスト分のトレース。spanごとの所要時間を記録する"""
+
+    def __init__(self, name, **attrs):
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.name = name
+        self.attrs = attrs
+        self.spans = []
+        self.error = None
+        self.sampled = _sampled()
+        self._start = time.perf_counter()
+        self._started_at = time.time()
+        self._profiler = None
+        if profile_switch.take():
+            self._profiler = SamplingProfiler(threading.get_ident())
+            self._profiler.start()
+
+    def elapsed_ms(self):
+        return (time.perf_counter() - self._start) * 1000
+
+    @contextmanager
+    def span(self, name, **attrs):
+        record = {"span": name, "offset_ms": round(self.elapsed_ms(), 2), **attrs}
+        start = time.perf_counter()
+        try:
+            yield record
+        except Exception as e:
+            record["error"] = repr(e)
+            raise
+        finally:
+            record["duration_ms"] = round((time.perf_counter() - start) * 1000, 2)
+            self.spans.append(record)
+
+    # 別スレッド等で計測済みの処理をspanとして追加（started/finishedはtime.perf_counter()の値）
+    def add_span(self, name, started, finished, **attrs):
+        self.spans.append({
+            "span": name,
+            "offset_ms": round((started - self._start) * 1000, 2),
+            **attrs,
+            "duration_ms": round((finished - started) * 1000, 2),
+        })
+
+    def finish(self):
+        duration_ms = self.elapsed_ms()
+        slow = duration_ms >= SLOW_REQUEST_MS
+        record = {
+            "trace_id": self.trace_id,
+            "name": self.name,
+            "started_at": self._started_at,
+            "duration_ms": round(duration_ms, 2),
+            "slow": slow,
+            **self.attrs,
+            "spans": self.spans,
+        }
+        if self.error:
+            record["error"] = self.error
+        if self._profiler is not None:
+            self._profiler.stop()
+            path = os.path.join(PROFILE_DIR, f"{self.trace_id}.folded")
+            record["profile"] = self._profiler.dump(path)
+            profile_switch.record_dump(path)
+        # 遅いリクエスト・エラー・プロファイル対象はサンプリングに関係なく全内訳を残す
+        if self.sampled or slow or self.error or self._profiler is not None:
+            _emit(record)
+        if slow:
+            breakdown = ", ".join(f"{s['span']}={s['duration_ms']}ms" for s in self.spans)
+            logger.warning(f"遅いリクエスト trace_id={self.trace_id} {duration_ms:.0f}ms ({breakdown})")
+        return record
+
+
+# トレースを開始し、コンテキストに設定する
+@contextmanager
+def start_trace(name, **attrs):
+    trace = Trace(name, **attrs)
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    except Exception as e:
+        trace.error = repr(e)
+        raise
+    finally:
+        _current_trace.reset(token)
+        trace.finish()
+
+
+def current_trace():
+    return _current_trace.get()
+
+
+# 別スレッドでトレースの処理を行う間、そのスレッドをトレースに結びつける
+# （1件ならspanの記録先にし、プロファイル中のトレースではサンプリング対象に加える）
+@contextmanager
+def attach(*traces):
+    traces = tuple(t for t in traces if t is not None)
+    tokens = [_attached_traces.set(traces)]
+    if len(traces) == 1:
+        tokens.append(_current_trace.set(traces[0]))
+    thread_id = threading.get_ident()
+    profilers = [t._profiler for t in traces if t._profiler is not None]
+    for profiler in profilers:
+        profiler.add_thread(thread_id)
+    try:
+        yield
+    finally:
+        for profiler in profilers:
+            profiler.remove_thread(thread_id)
+        for token in reversed(tokens):
+            token.var.reset(token)
+
+
+# 現在のトレースを引き継いで別スレッドで実行する関数を返す（スレッドプールへの投入用）
+def bind(func):
+    traces = _attached_traces.get() or tuple(t for t in (_current_trace.get(),) if t is not None)
+    if not traces:
+        return func
+
+    def run(*args, **kwargs):
+        with attach(*traces):
+            return func(*args, **kwargs)
+    return run
+
+
+# spanの記録先（バッチ処理中は結びつけた全トレース、それ以外は現在のトレース）
+def _span_targets():
+    return _attached_traces.get() or tuple(t for t in (_current_trace.get(),) if t is not None)
+
+
+# 現在のトレースにspanを追加（トレース外では何もしない）
+# 複数のトレースをまとめて処理している間は、同じ区間を各トレースに記録する
+@contextmanager
+def span(name, **attrs):
+    traces = _span_targets()
+    if not traces:
+        yield {}
+        return
+    if len(traces) == 1:
+        with traces[0].span(name, **attrs) as record:
+            yield record
+        return
+    record = dict(attrs)
+    started = time.perf_counter()
+    try:
+        yield record
+    except Exception as e:
+        record["error"] = repr(e)
+        raise
+    finally:
+        finished = time.perf_counter()
+        for trace in traces:
+            trace.add_span(name, started, finished, **record)
+
+
+# 計測済みの区間を現在のトレースに追加（トレース外では何もしない）
+def record_span(name, started, finished, **attrs):
+    for trace in _span_targets():
+        trace.add_span(name, started, finished, **attrs)
+
+
+# 単発イベントの構造化ログ（サンプリングあり）
+def log_event(kind, **fields):
+    if not _sampled():
+        return
+    _emit({"event": kind, "logged_at": time.time(), **fields})
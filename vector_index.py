@@ -0,0 +1,437 @@
+import os
+import json
+import heapq
+import logging
+import threading
+from itertools import groupby
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import tracing
+
+logger = logging.getLogger(__name__)
+
+# インデックスに載せる列（raw_jsonはメモリ節約のため載せない）
+# channel_id は migrations/002_channel_id_column.sql で追加した列
+INDEX_COLUMNS = "id, channel_id, message_text, user_id, timestamp, embedding"
+
+# search_manyで1回の行列積にまとめるクエリ数（スコア行列のメモリ上限）
+QUERY_BLOCK = 256
+
+# フィルタ条件ごとの行マスクを保持する上限
+MASK_CACHE_SIZE = 64
+
+# シャード並列走査のスレッド数と、並列化する最小行数（小さいインデックスは逐次の方が速い）
+SHARD_SCAN_THREADS = int(os.getenv("SHARD_SCAN_THREADS", str(os.cpu_count() or 1)))
+PARALLEL_SCAN_MIN_ROWS = 20000
+
+
+# embedding列をfloat配列に変換（pgvectorは文字列で返ることがある）
+def parse_embedding(value):
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = json.loads(value)
+    return [float(x) for x in value]
+
+
+# レコードの項目値（"month"はtimestampの年月。where条件・パーティションキーで共通）
+def record_field(record, field):
+    if field == "month":
+        return str(record.get("timestamp") or "")[:7] or "unknown"
+    return record.get(field)
+
+
+# 行ごとにL2正規化（ゼロベクトルはそのまま）
+def normalize_rows(matrix):
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+# 各行のスコア上位k件の(列番号, スコア)を降順で返す
+def top_k_rows(scores, k):
+    k = min(k, scores.shape[1])
+    part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    part_scores = np.take_along_axis(scores, part, axis=1)
+    order = np.argsort(-part_scores, axis=1)
+    return np.take_along_axis(part, order, axis=1), np.take_along_axis(part_scores, order, axis=1)
+
+
+class EmbeddingIndex:
+    """正規化済みembedding行列とメタデータを保持し、行列積でコサイン類似検索を行う"""
+
+    def __init__(self, embeddings, records):
+        if len(embeddings) != len(records):
+            raise ValueError("embeddingsとrecordsの件数が一致しません")
+        self.matrix = normalize_rows(embeddings) if len(records) else np.zeros((0, 0), dtype=np.float32)
+        self.records = records
+
+    # 正規化済みの行列（共有メモリ上の読み取り専用配列など）をコピーせずに使う
+    @classmethod
+    def from_normalized(cls, matrix, records):
+        index = cls.__new__(cls)
+        index.matrix = matrix
+        index.records = records
+        return index
+
+    def __len__(self):
+        return len(self.records)
+
+    @property
+    def dim(self):
+        return self.matrix.shape[1] if self.matrix.ndim == 2 else 0
+
+    # 行番号に対応する正規化済みベクトル
+    def row_vector(self, i):
+        return self.matrix[i]
+
+    # クエリ行列（正規化済み）と全行のコサイン類似度
+    def _scores(self, queries):
+        return queries @ self.matrix.T
+
+    # whereの全項目がレコードと一致する行のマスク（where未指定時はNone）。条件ごとにキャッシュする
+    def filter_mask(self, where):
+        if not where:
+            return None
+        cache = self.__dict__.setdefault("_mask_cache", {})
+        key = tuple(sorted(where.items()))
+        mask = cache.get(key)
+        if mask is None:
+            if len(cache) >= MASK_CACHE_SIZE:
+                cache.clear()
+            mask = np.array([all(record_field(r, k) == v for k, v in where.items()) for r in self.records], dtype=bool)
+            cache[key] = mask
+        return mask
+
+    # with_vectors=Trueの場合、各結果に正規化済みベクトル("vector")を付与する（MMR用）
+    def search(self, query_embedding, top_k=5, min_similarity=0.0, with_vectors=False, where=None):
+        return self.search_many([query_embedding], top_k, min_similarity, with_vectors, where)[0]
+
+    # 複数クエリを行列積1回（QUERY_BLOCK件ずつ）でまとめて検索し、クエリごとの上位k件を返す
+    def search_many(self, query_embeddings, top_k=5, min_similarity=0.0, with_vectors=False, where=None):
+        return [
+            self._results(rows, sims, min_similarity, with_vectors)
+            for rows, sims in self.search_rows_many(query_embeddings, top_k, where)
+        ]
+
+    # クエリごとの上位k件を(行番号配列, 類似度配列)で返す
+    def search_rows_many(self, query_embeddings, top_k=5, where=None):
+        if not len(query_embeddings):
+            return []
+        queries = normalize_rows(np.atleast_2d(np.asarray(query_embeddings, dtype=np.float32)))
+        if not len(self) or top_k <= 0:
+            return [(np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)) for _ in range(len(queries))]
+        mask = self.filter_mask(where)
+        hits = []
+        for start in range(0, len(queries), QUERY_BLOCK):
+            scores = self._scores(queries[start:start + QUERY_BLOCK])
+            if mask is not None:
+                scores[:, ~mask] = -np.inf
+            for rows, sims in zip(*top_k_rows(scores, top_k)):
+                keep = np.isfinite(sims)  # フィルタで除外した行は返さない
+                hits.append((rows[keep], sims[keep]))
+        return hits
+
+    def _results(self, rows, sims, min_similarity, with_vectors):
+        results = []
+        for i, similarity in zip(rows, sims):
+            if similarity < min_similarity:
+                continue
+            result = {**self.records[i], "similarity": float(similarity)}
+            if with_vectors:
+                result["vector"] = self.row_vector(i)
+            results.append(result)
+        return results
+
+
+class QuantizedIndex(EmbeddingIndex):
+    """int8スカラー量子化インデックス（行ごとのスケール）。メモリはfloat32の約1/4
+
+    省メモリ用で、検索は速くならない（numpyの整数行列積はBLASを使わないため、
+    小さな行ブロックずつfloat32へ戻して行列積を取る）。
+    """
+
+    ROW_BLOCK = 2048  # スコア計算時にfloat32へ戻す行数（1536次元で約12MBの一時領域）
+
+    def __init__(self, embeddings, records):
+        if len(embeddings) != len(records):
+            raise ValueError("embeddingsとrecordsの件数が一致しません")
+        normalized = normalize_rows(embeddings) if len(records) else np.zeros((0, 0), dtype=np.float32)
+        scales = np.abs(normalized).max(axis=1) / 127.0 if len(records) else np.zeros(0, dtype=np.float32)
+        scales[scales == 0] = 1.0
+        self.codes = np.round(normalized / scales[:, None]).astype(np.int8)
+        self.scales = scales.astype(np.float32)
+        self.records = records
+
+    @property
+    def dim(self):
+        return self.codes.shape[1] if self.codes.ndim == 2 else 0
+
+    def row_vector(self, i):
+        return self.codes[i].astype(np.float32) * self.scales[i]
+
+    def _scores(self, queries):
+        scores = np.empty((len(queries), len(self.codes)), dtype=np.float32)
+        buffer = np.empty((min(self.ROW_BLOCK, len(self.codes)), self.dim), dtype=np.float32)
+        for start in range(0, len(self.codes), self.ROW_BLOCK):
+            codes = self.codes[start:start + self.ROW_BLOCK]
+            block = buffer[:len(codes)]
+            block[...] = codes  # 一時領域を使い回してint8→float32へ変換
+            scores[:, start:start + len(codes)] = queries @ block.T
+        scores *= self.scales
+        return scores
+
+
+class IVFIndex(EmbeddingIndex):
+    """転置ファイル(IVF)による近似最近傍検索。k-meansのクラスタのうちnprobe個だけを走査する"""
+
+    def __init__(self, embeddings, records, nlist=None, nprobe=8, iterations=10, seed=0):
+        super().__init__(embeddings, records)
+        self.nprobe = nprobe
+        if not len(self):
+            self.centroids = np.zeros((0, 0), dtype=np.float32)
+            self.lists = []
+            return
+        nlist = min(len(self), nlist or max(1, int(np.sqrt(len(self)))))
+        self.centroids = self._train(nlist, iterations, np.random.default_rng(seed))
+        assignments = self._assign(self.matrix)
+        self.lists = [np.flatnonzero(assignments == c) for c in range(nlist)]
+
+    def _assign(self, vectors):
+        return np.concatenate([
+            np.argmax(vectors[start:start + QUERY_BLOCK * 16] @ self.centroids.T, axis=1)
+            for start in range(0, len(vectors), QUERY_BLOCK * 16)
+        ])
+
+    # 球面k-means（サンプル上で学習）
+    def _train(self, nlist, iterations, rng):
+        sample_size = min(len(self), nlist * 64)
+        sample = self.matrix[rng.choice(len(self), sample_size, replace=False)]
+        self.centroids = sample[rng.choice(sample_size, nlist, replace=False)].copy()
+        for _ in range(iterations):
+            assignments = self._assign(sample)
+            for c in range(nlist):
+                members = sample[assignments == c]
+                if len(members):
+                    self.centroids[c] = members.sum(axis=0)
+                else:  # 空クラスタはランダムな点で再初期化
+                    self.centroids[c] = sample[rng.integers(sample_size)]
+            self.centroids = normalize_rows(self.centroids)
+        return self.centroids
+
+    def search_rows_many(self, query_embeddings, top_k=5, where=None):
+        if not len(query_embeddings):
+            return []
+        queries = normalize_rows(np.atleast_2d(np.asarray(query_embeddings, dtype=np.float32)))
+        empty = (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32))
+        if not len(self) or top_k <= 0:
+            return [empty for _ in range(len(queries))]
+        mask = self.filter_mask(where)
+        probes, _ = top_k_rows(queries @ self.centroids.T, self.nprobe)
+        hits = []
+        for query, probe in zip(queries, probes):
+            candidates = np.concatenate([self.lists[c] for c in probe])
+            if mask is not None:
+                candidates = candidates[mask[candidates]]
+            if not len(candidates):
+                hits.append(empty)
+                continue
+            scores = self.matrix[candidates] @ query
+            rows, sims = top_k_rows(scores[None, :], top_k)
+            hits.append((candidates[rows[0]], sims[0]))
+        return hits
+
+
+# "month,channel_id" のような指定をフィールド名のリストに変換（"none"・空は分割しない）
+def partition_fields(spec):
+    return [f.strip() for f in (spec or "").split(",") if f.strip() not in ("", "none")]
+
+
+# パーティションキー（"month"はtimestampの年月、それ以外はレコードの同名フィールド）
+def partition_key(record, partition_by):
+    return tuple(str(record_field(record, field) or "") for field in partition_by)
+
+
+# 行をパーティションキー順に並べ替えたインデックスを返す（並び済みならそのまま返す）
+def sort_by_partition(index, partition_by):
+    keys = [partition_key(r, partition_by) for r in index.records]
+    order = sorted(range(len(keys)), key=keys.__getitem__)
+    if order == list(range(len(keys))):
+        return index
+    return EmbeddingIndex.from_normalized(index.matrix[order], [index.records[i] for i in order])
+
+
+_scan_executor = None
+_scan_executor_lock = threading.Lock()
+
+
+# シャード走査用のスレッドプール（初回利用時に生成。pre-forkの場合はfork後に作られる）
+def scan_executor():
+    global _scan_executor
+    with _scan_executor_lock:
+        if _scan_executor is None:
+            _scan_executor = ThreadPoolExecutor(SHARD_SCAN_THREADS, thread_name_prefix="shard-scan")
+    return _scan_executor
+
+
+class ShardedIndex:
+    """パーティション（月・チャンネル）ごとのシャードをスレッドプールで並列に走査し、
+    シャードごとの上位k件をヒープでマージする。
+
+    封印済みシャードは変更せず、新しい行は小さな可変のheadシャードに追加する。
+    compact()でheadを各パーティションへ統合した新しいシャードに差し替える。
+    """
+
+    def __init__(self, shards, partition_by):
+        self.partition_by = tuple(partition_by)
+        self.shards = shards  # [(key, EmbeddingIndex)]（キー順、変更しない）
+        self.head = None
+        self._lock = threading.Lock()
+
+    # 単一インデックスをパーティションごとのシャードに分割（並び済みの行列ならコピーせずスライスを使う）
+    @classmethod
+    def from_index(cls, index, partition_by):
+        index = sort_by_partition(index, partition_by)
+        shards = []
+        start = 0
+        for key, group in groupby(partition_key(r, partition_by) for r in index.records):
+            end = start + sum(1 for _ in group)
+            shards.append((key, EmbeddingIndex.from_normalized(index.matrix[start:end], index.records[start:end])))
+            start = end
+        return cls(shards, partition_by)
+
+    def __len__(self):
+        shards, head = self._snapshot()
+        return sum(len(shard) for _, shard in shards) + (len(head) if head is not None else 0)
+
+    @property
+    def dim(self):
+        shards, head = self._snapshot()
+        for _, shard in shards + ([(None, head)] if head is not None else []):
+            return shard.dim
+        return 0
+
+    @property
+    def head_rows(self):
+        head = self.head
+        return len(head) if head is not None else 0
+
+    def _snapshot(self):
+        with self._lock:
+            return self.shards, self.head
+
+    # whereに含まれるパーティション項目と一致しないシャードは走査しない
+    def _may_match(self, key, where):
+        if not where or key is None:
+            return True
+        fields = dict(zip(self.partition_by, key))
+        return all(fields[k] == str(v) for k, v in where.items() if k in fields)
+
+    def search(self, query_embedding, top_k=5, min_similarity=0.0, with_vectors=False, where=None):
+        return self.search_many([query_embedding], top_k, min_similarity, with_vectors, where)[0]
+
+    def search_many(self, query_embeddings, top_k=5, min_similarity=0.0, with_vectors=False, where=None):
+        if not len(query_embeddings):
+            return []
+        queries = normalize_rows(np.atleast_2d(np.asarray(query_embeddings, dtype=np.float32)))
+        shards, head = self._snapshot()
+        # 封印済みシャードはパーティション項目を満たしているので、残りの条件だけで絞り込む
+        shard_where = {k: v for k, v in (where or {}).items() if k not in self.partition_by} or None
+        targets = [(shard, shard_where) for key, shard in shards if self._may_match(key, where)]
+        if head is not None:
+            targets.append((head, where))
+
+        def scan(target):
+            shard, shard_where = target
+            return shard.search_rows_many(queries, top_k, shard_where)
+
+        if len(targets) > 1 and sum(len(shard) for shard, _ in targets) >= PARALLEL_SCAN_MIN_ROWS:
+            hits = list(scan_executor().map(tracing.bind(scan), targets))
+        else:
+            hits = [scan(shard) for shard in targets]
+
+        results = []
+        for q in range(len(queries)):
+            merged = heapq.nlargest(top_k, (
+                (float(sim), s, int(row))
+                for s, shard_hits in enumerate(hits)
+                for row, sim in zip(*shard_hits[q])
+            ))
+            results.append([
+                result
+                for sim, s, row in merged
+                for result in targets[s][0]._results([row], [sim], min_similarity, with_vectors)
+            ])
+        return results
+
+    # 新しい行をheadシャードに追加（コピーオンライトで差し替え、検索中のスナップショットには影響しない）
+    def add(self, embeddings, records):
+        if not len(records):
+            return
+        vectors = normalize_rows(embeddings)
+        with self._lock:
+            if self.head is None:
+                self.head = EmbeddingIndex.from_normalized(vectors, list(records))
+            else:
+                self.head = EmbeddingIndex.from_normalized(
+                    np.vstack([self.head.matrix, vectors]), self.head.records + list(records)
+                )
+
+    # headの行を各パーティションのシャードへ統合し、新しいシャード一覧に差し替える
+    def compact(self):
+        with self._lock:
+            head = self.head
+            if head is None:
+                return
+            shards = dict(self.shards)
+            grouped = {}
+            for i, record in enumerate(head.records):
+                grouped.setdefault(partition_key(record, self.partition_by), []).append(i)
+            for key, rows in grouped.items():
+                matrix, records = head.matrix[rows], [head.records[i] for i in rows]
+                if key in shards:
+                    old = shards[key]
+                    matrix, records = np.vstack([old.matrix, matrix]), old.records + records
+                shards[key] = EmbeddingIndex.from_normalized(matrix, records)
+            self.shards = sorted(shards.items(), key=lambda item: item[0])
+            self.head = None
+
+
+# Supabaseからページングしながら全件読み込み、インデックスを構築
+# model/dimを指定すると、そのモデル・次元で埋め込まれた行だけを読み込む
+# after_idを指定するとそれより新しい行だけを読み込む（差分更新用）
+def load_index_from_supabase(client, table="slack_messages", model=None, dim=None, page_size=1000, progress=None,
+                             after_id=None):
+    embeddings = []
+    records = []
+    start = 0
+    while True:
+        query = client.table(table).select(INDEX_COLUMNS)
+        if model:
+            query = query.eq("embedding_model", model)
+        if dim:
+            query = query.eq("embedding_dim", dim)
+        if after_id is not None:
+            query = query.gt("id", after_id)
+        res = query.order("id").range(start, start + page_size - 1).execute()
+        rows = res.data or []
+        for row in rows:
+            try:
+                embedding = parse_embedding(row.pop("embedding", None))
+            except Exception as e:
+                logger.error(f"embedding処理エラー: id={row.get('id')} {e}")
+                continue
+            if not embedding:
+                continue
+            if embeddings and len(embedding) != len(embeddings[0]):
+                logger.warning(f"次元数の異なるembeddingをスキップ: id={row.get('id')} dim={len(embedding)}")
+                continue
+            embeddings.append(embedding)
+            records.append(row)
+        start += len(rows)
+        if progress:
+            progress(len(records))
+        if len(rows) < page_size:
+            break
+    return EmbeddingIndex(embeddings, records)